@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Versioned online migrations for the production database.
+
+Usage:
+    python migrate.py status
+    python migrate.py up [--target VERSION] [--batch-size N]
+
+Each migration rewrites documents in small batches with server-side updates,
+so it can run while the API is serving traffic.
+"""
+import argparse
+import asyncio
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+ORDER_COLLECTIONS = ['orders', 'orders_archive']
+
+def string_to_date(field: str) -> dict:
+    """Aggregation expression converting a legacy ISO string field to a BSON date"""
+    # Без timezone: created_at хранится с '+00:00', а Mongo отклоняет строку со смещением вместе с timezone.
+    # Строки без смещения (даты этапов) и так разбираются как UTC
+    return {'$cond': [
+        {'$eq': [{'$type': field}, 'string']},
+        {'$dateFromString': {'dateString': field, 'onError': field}},
+        field,
+    ]}
+
+async def migrate_stage_dates_to_bson(db, batch_size: int) -> int:
+    """v1: stage start_date/end_date and order created_at from ISO strings to native dates"""
+    legacy = {'$or': [
+        {'created_at': {'$type': 'string'}},
+        {'stages.start_date': {'$type': 'string'}},
+        {'stages.end_date': {'$type': 'string'}},
+    ]}
+    pipeline = [{'$set': {
+        'created_at': string_to_date('$created_at'),
+        'stages': {'$map': {
+            'input': '$stages',
+            'as': 's',
+            'in': {'$mergeObjects': ['$$s', {
+                'start_date': string_to_date('$$s.start_date'),
+                'end_date': string_to_date('$$s.end_date'),
+            }]},
+        }},
+    }}]
+    remaining = 0
+    for name in ORDER_COLLECTIONS:
+        collection = db[name]
+        migrated = 0
+        last_id = None
+        while True:
+            # Строки, которые не удалось разобрать, остаются как есть: идём по _id, чтобы не зацикливаться на них
+            query = dict(legacy, **({'_id': {'$gt': last_id}} if last_id is not None else {}))
+            batch = await collection.find(query, {'_id': 1}).sort('_id', 1).limit(batch_size).to_list(batch_size)
+            if not batch:
+                break
+            last_id = batch[-1]['_id']
+            # Обновление-конвейер атомарно для каждого документа и не затирает параллельные записи API
+            result = await collection.update_many({'_id': {'$in': [doc['_id'] for doc in batch]}}, pipeline)
+            migrated += result.modified_count
+        left = await collection.count_documents(legacy)
+        print(f"  {name}: {migrated} documents migrated, {left} with unparseable dates left")
+        remaining += left
+    return remaining
+
+async def migrate_compact_stages(db, batch_size: int) -> int:
+    """v2: replace stage name and UUID with the registry code, drop empty stage fields"""
+    definitions = await db.stage_definitions.find().to_list(None)
+    if not definitions:
+        raise SystemExit("Stage definitions are missing: start the API once so it seeds db.stage_definitions")
+    code_by_name = {'$switch': {
+        'branches': [{'case': {'$eq': ['$$s.name', d['name']]}, 'then': d['code']} for d in definitions],
+        'default': None,
+    }}
+    legacy = {'stages.name': {'$exists': True}}
+    pipeline = [{'$set': {'stages': {'$map': {
+        'input': '$stages',
+        'as': 's',
+        'in': {'$let': {
+            'vars': {'code': {'$ifNull': ['$$s.code', code_by_name]}},
+            'in': {'$cond': [
+                {'$eq': ['$$code', None]},
+                '$$s',  # этап вне реестра оставляем без изменений
+                {'$arrayToObject': {'$concatArrays': [
+                    [{'k': 'code', 'v': '$$code'}],
+                    {'$filter': {
+                        'input': {'$objectToArray': '$$s'},
+                        'as': 'f',
+                        'cond': {'$and': [
+                            {'$not': [{'$in': ['$$f.k', ['id', 'name', 'code']]}]},
+                            {'$ne': ['$$f.v', None]},
+                        ]},
+                    }},
+                ]}},
+            ]},
+        }},
+    }}}}]
+    for name in ORDER_COLLECTIONS:
+        collection = db[name]
+        migrated = 0
+        last_id = None
+        while True:
+            # Этапы вне реестра сохраняют name, поэтому идём по _id, а не повторяем выборку legacy
+            query = dict(legacy, **({'_id': {'$gt': last_id}} if last_id is not None else {}))
+            batch = await collection.find(query, {'_id': 1}).sort('_id', 1).limit(batch_size).to_list(batch_size)
+            if not batch:
+                break
+            last_id = batch[-1]['_id']
+            result = await collection.update_many({'_id': {'$in': [doc['_id'] for doc in batch]}}, pipeline)
+            migrated += result.modified_count
+        print(f"  {name}: {migrated} documents migrated")
+    # Этапы вне реестра намеренно остаются с name
+    return 0
+
+# Каждая миграция возвращает число документов, которые не удалось перенести
+MIGRATIONS = [
+    (1, 'stage_dates_to_bson', migrate_stage_dates_to_bson),
+    (2, 'compact_stages', migrate_compact_stages),
+]
+
+async def applied_versions(db) -> dict:
+    return {doc['_id']: doc async for doc in db.migrations.find()}
+
+async def status(db):
+    applied = await applied_versions(db)
+    for version, name, _ in MIGRATIONS:
+        mark = applied[version]['applied_at'].isoformat() if version in applied else 'pending'
+        print(f"{version:>4}  {name:<32} {mark}")
+
+async def up(db, target: int, batch_size: int):
+    applied = await applied_versions(db)
+    for version, name, migration in MIGRATIONS:
+        if version > target or version in applied:
+            continue
+        print(f"Applying {version} {name}...")
+        remaining = await migration(db, batch_size)
+        if remaining:
+            # Версия не записывается: после исправления данных миграцию можно запустить повторно
+            raise SystemExit(f"Migration {version} left {remaining} documents unmigrated; fix them and run again")
+        await db.migrations.insert_one({
+            '_id': version,
+            'name': name,
+            'applied_at': datetime.now(timezone.utc),
+        })
+    print("Database is up to date")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run database migrations")
+    parser.add_argument('command', choices=['status', 'up'])
+    parser.add_argument('--target', type=int, default=MIGRATIONS[-1][0])
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if args.command == 'status':
+            await status(db)
+        else:
+            await up(db, args.target, args.batch_size)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Move existing order attachments between storage backends.
+
+Usage:
+    python migrate_files.py --to s3 [--delete-source] [--dry-run]
+
+Reads the same .env as the API (STORAGE_BACKEND, S3_BUCKET, S3_ENDPOINT_URL...).
+Each file is copied first and its FileInfo updated afterwards, so the script
+can be interrupted and re-run at any point.
+"""
+import argparse
+import asyncio
+from pathlib import Path
+
+from server import ARCHIVE_COLLECTION, client, db, file_location, storages
+
+async def migrate_files(target_name: str, delete_source: bool, dry_run: bool):
+    target = storages.get(target_name)
+    if target is None:
+        raise SystemExit(f"Storage backend {target_name} is not configured")
+
+    moved = 0
+    for collection in (db.orders, db[ARCHIVE_COLLECTION]):
+        query = {'files': {'$elemMatch': {'storage': {'$ne': target_name}}}}
+        async for order_data in collection.find(query, {'id': 1, 'files': 1}):
+            for file_info in order_data.get('files', []):
+                if (file_info.get('storage') or 'local') == target_name:
+                    continue
+                source, key = file_location(file_info)
+                print(f"{order_data['id']}: {file_info['original_filename']} ({source.name} -> {target_name})")
+                if dry_run:
+                    continue
+                if not await source.exists(key):
+                    print("  missing in source storage, skipped")
+                    continue
+                async with source.local_copy(key) as local_path:
+                    await target.put_file(key, Path(local_path))
+                await collection.update_one(
+                    {'id': order_data['id'], 'files.id': file_info['id']},
+                    {'$set': {
+                        'files.$.storage': target_name,
+                        'files.$.storage_key': key,
+                        'files.$.file_path': str(target.path(key)) if target_name == 'local' else None,
+                    }},
+                )
+                if delete_source:
+                    await source.delete(key)
+                moved += 1
+    print(f"Moved {moved} files")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Move attachments between storage backends")
+    parser.add_argument('--to', required=True, dest='target')
+    parser.add_argument('--delete-source', action='store_true')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    try:
+        await migrate_files(args.target, args.delete_source, args.dry_run)
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,20 +1,49 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Depends, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring, CursorType, ReturnDocument, DeleteOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
 import os
+import sys
+import collections
+import traceback
 import logging
+import logging.handlers
+import asyncio
+import multiprocessing
+import json
+import queue
+import random
+import contextvars
+import re
+import shutil
+import socket
+import tempfile
+from contextlib import asynccontextmanager
+from urllib.parse import quote
+import threading
+import time
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, date
 import jwt
 import hashlib
+import mimetypes
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 import aiofiles
+import numpy as np
+import pandas as pd
+import boto3
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError as BotoClientError
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -22,12 +51,149 @@ load_dotenv(ROOT_DIR / '.env')
 # Create uploads directory
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# MongoDB connection pool statistics
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Collects live connection pool checkout/wait statistics from pymongo events"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pools = 0
+        self.connections_open = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.checkouts_total = 0
+        self.checkout_failures = 0
+        self.checkout_failure_reasons = {}
+        self.pool_clears = 0
+
+    def pool_created(self, event):
+        with self._lock:
+            self.pools += 1
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.pool_clears += 1
+
+    def pool_closed(self, event):
+        with self._lock:
+            self.pools = max(0, self.pools - 1)
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_open += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_open = max(0, self.connections_open - 1)
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.waiting = max(0, self.waiting - 1)
+            self.checkout_failures += 1
+            reason = str(event.reason)
+            self.checkout_failure_reasons[reason] = self.checkout_failure_reasons.get(reason, 0) + 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.waiting = max(0, self.waiting - 1)
+            self.checked_out += 1
+            self.checkouts_total += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out = max(0, self.checked_out - 1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'pools': self.pools,
+                'connections_open': self.connections_open,
+                'checked_out': self.checked_out,
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'checkouts_total': self.checkouts_total,
+                'checkout_failures': self.checkout_failures,
+                'checkout_failure_reasons': dict(self.checkout_failure_reasons),
+                'pool_clears': self.pool_clears,
+            }
+
+def mongo_client_options() -> dict:
+    """Build AsyncIOMotorClient pool options from environment configuration"""
+    options = {
+        'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', '50')),
+        'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', '0')),
+        'waitQueueTimeoutMS': int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', '2000')),
+        'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+        'readPreference': os.environ.get('MONGO_READ_PREFERENCE', 'primary'),
+    }
+    # Допустимые значения: zstd, snappy, zlib (через запятую, в порядке предпочтения).
+    # zstd требует пакет zstandard, snappy — python-snappy
+    compressors = os.environ.get('MONGO_COMPRESSORS', '').strip()
+    if compressors:
+        options['compressors'] = compressors
+    return options
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+pool_stats = PoolStatsListener()
+# tz_aware: BSON даты читаются как aware UTC и сравниваются с datetime.now(timezone.utc) без приведения
+client = AsyncIOMotorClient(
+    mongo_url, tz_aware=True, tzinfo=timezone.utc, event_listeners=[pool_stats], **mongo_client_options()
+)
 db = client[os.environ['DB_NAME']]
 
+# Read routing: тяжёлые чтения можно отправлять на вторичные узлы, чтобы не мешать записи этапов
+READ_PREFERENCE_MODES = {
+    'primary': lambda staleness: Primary(),
+    'primaryPreferred': lambda staleness: PrimaryPreferred(max_staleness=staleness),
+    'secondary': lambda staleness: Secondary(max_staleness=staleness),
+    'secondaryPreferred': lambda staleness: SecondaryPreferred(max_staleness=staleness),
+    'nearest': lambda staleness: Nearest(max_staleness=staleness),
+}
+DEFAULT_READ_ROUTES = {
+    'order_detail': 'primary',  # сразу после записи клиент должен увидеть свои изменения
+    'orders_list': 'secondaryPreferred',  # дашборд и диаграмма Ганта
+    'search': 'secondaryPreferred',
+    'reports': 'secondaryPreferred',
+}
+# Не меньше 90 секунд — минимум, допустимый драйвером; -1 отключает ограничение
+MONGO_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_MAX_STALENESS_SECONDS', '90'))
+
+def load_read_routes() -> dict:
+    routes = dict(DEFAULT_READ_ROUTES)
+    routes.update(json.loads(os.environ.get('READ_ROUTING', '{}')))
+    for operation, mode in routes.items():
+        if mode not in READ_PREFERENCE_MODES:
+            raise ValueError(f"Unknown read preference {mode} for {operation}")
+    return routes
+
+read_routes = load_read_routes()
+_read_databases = {}
+
+def read_db(operation: str):
+    """Database handle with the read preference configured for this kind of read"""
+    database = _read_databases.get(operation)
+    if database is None:
+        mode = read_routes.get(operation, 'primary')
+        database = _read_databases[operation] = client.get_database(
+            os.environ['DB_NAME'], read_preference=READ_PREFERENCE_MODES[mode](MONGO_MAX_STALENESS_SECONDS)
+        )
+    return database
+
 # JWT Secret
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 
@@ -84,6 +250,7 @@ class LoginResponse(BaseModel):
 
 class ProductionStage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    code: Optional[str] = None  # код этапа в реестре определений
     name: str
     status: StageStatus = StageStatus.PENDING
     start_date: Optional[date] = None
@@ -93,12 +260,43 @@ class ProductionStage(BaseModel):
     notes: Optional[str] = None
     responsible_person: Optional[str] = None
 
+    @model_validator(mode='before')
+    @classmethod
+    def resolve_definition(cls, data):
+        """Expand compact stored stages (code only) with name, id and unit counter from the registry"""
+        if not isinstance(data, dict) or not data.get('code'):
+            return data
+        definition = stage_registry.get(data['code'])
+        data = dict(data)
+        data.setdefault('id', data['code'])
+        if not data.get('name'):
+            data['name'] = definition.name if definition else data['code']
+        if definition and definition.has_units and data.get('completed_units') is None:
+            data['completed_units'] = 0
+        return data
+
+class FileStatus(str, Enum):
+    PENDING = "pending"
+    PROCESSING = "processing"
+    READY = "ready"
+    FAILED = "failed"
+
 class FileInfo(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     filename: str
     original_filename: str
-    file_path: str
+    file_path: Optional[str] = None  # только для локального хранилища
+    storage: str = "local"
+    storage_key: Optional[str] = None
     uploaded_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    # Заполняются фоновой обработкой после загрузки
+    status: FileStatus = FileStatus.READY
+    job_id: Optional[str] = None
+    sha256: Optional[str] = None
+    size: Optional[int] = None
+    content_type: Optional[str] = None
+    processed_at: Optional[datetime] = None
+    processing_error: Optional[str] = None
 
 class Order(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -112,10 +310,15 @@ class Order(BaseModel):
     processing_types: List[ProcessingType] = []  # список типов обработки
     minute_rate_domestic: float = 25.0  # гривен за минуту
     minute_rate_foreign: float = 0.42  # долларов за минуту
+    workflow: str = "standard"  # маршрут этапов
+    workflow_version: int = 1  # версия маршрута, по которой созданы этапы заказа
     files: List[FileInfo] = []
     stages: List[ProductionStage] = []
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     created_by: str
+    archived_at: Optional[datetime] = None
+    revision: int = 0
+    updated_at: Optional[datetime] = None
 
     @property
     def processing_cost_per_unit(self) -> float:
@@ -135,7 +338,7 @@ class Order(BaseModel):
         return self.total_cost_per_unit * self.quantity
 
 class OrderCreate(BaseModel):
-    order_number: str
+    order_number: Optional[str] = None  # присваивается сервером, если не указан
     client_name: str
     description: str
     quantity: int
@@ -145,6 +348,7 @@ class OrderCreate(BaseModel):
     processing_types: List[ProcessingType] = []
     minute_rate_domestic: Optional[float] = 25.0
     minute_rate_foreign: Optional[float] = 0.42
+    workflow: Optional[str] = None  # по умолчанию выбирается по видам обработки
 
 class OrderUpdate(BaseModel):
     client_name: Optional[str] = None
@@ -157,6 +361,9 @@ class OrderUpdate(BaseModel):
     minute_rate_domestic: Optional[float] = None
     minute_rate_foreign: Optional[float] = None
 
+class StageIncrement(BaseModel):
+    delta: int = 1
+
 class StageUpdate(BaseModel):
     status: Optional[StageStatus] = None
     start_date: Optional[date] = None
@@ -182,22 +389,47 @@ def create_access_token(user_id: str, username: str, role: str) -> str:
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> User:
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=['HS256'])
+        bind_request_user(payload['user_id'])
+        cache_key = f"user:{payload['user_id']}"
+        user = user_cache.get(cache_key)
+        if user is not None:
+            return user
         user_data = await db.users.find_one({'id': payload['user_id']})
         if not user_data:
             raise HTTPException(status_code=401, detail="User not found")
-        return User(**user_data)
+        user = User(**user_data)
+        user_cache.set(cache_key, user, tags=[cache_key, 'users'])
+        return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def to_bson_date(value: date) -> datetime:
+    """BSON has no date-only type: calendar dates are stored as midnight UTC"""
+    return datetime(value.year, value.month, value.day, tzinfo=timezone.utc)
+
+def stage_day(value) -> Optional[date]:
+    """Calendar date of a stored stage date: a BSON datetime, or an ISO string not yet migrated"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(str(value)[:10]) if value else None
+    except ValueError:
+        return None
+
 def prepare_for_mongo(data):
-    """Convert dates to ISO strings for MongoDB storage"""
+    """Convert calendar dates to native BSON dates for MongoDB storage.
+
+    Reads need no conversion: Pydantic accepts midnight datetimes for `date` fields
+    (and still parses ISO strings left over from before the migration)."""
     if isinstance(data, dict):
         result = {}
         for key, value in data.items():
-            if isinstance(value, date):
-                result[key] = value.isoformat()
+            if isinstance(value, date) and not isinstance(value, datetime):
+                result[key] = to_bson_date(value)
             elif isinstance(value, list):
                 result[key] = [prepare_for_mongo(item) for item in value]
             elif isinstance(value, dict):
@@ -207,408 +439,3635 @@ def prepare_for_mongo(data):
         return result
     return data
 
-def parse_from_mongo(data):
-    """Parse dates from MongoDB"""
-    if isinstance(data, dict):
-        result = {}
-        for key, value in data.items():
-            if key in ['start_date', 'end_date'] and isinstance(value, str):
-                try:
-                    result[key] = datetime.fromisoformat(value).date()
-                except ValueError:
-                    result[key] = value
-            elif isinstance(value, list):
-                result[key] = [parse_from_mongo(item) for item in value]
-            elif isinstance(value, dict):
-                result[key] = parse_from_mongo(value)
-            else:
-                result[key] = value
-        return result
-    return data
+def filter_order_for_role(order: Order, user: User) -> Order:
+    """Hide cost information and files from employees"""
+    if user.role != UserRole.EMPLOYEE:
+        return order
+    order_dict = order.dict()
+    order_dict['material_cost'] = 0
+    order_dict['hourly_rate_domestic'] = 0
+    order_dict['hourly_rate_foreign'] = 0
+    order_dict['files'] = []
+    return Order(**order_dict)
 
 # Initialize default stages
-def create_default_stages() -> List[ProductionStage]:
-    stages_config = [
-        {"name": "Получение заказа на оценку", "has_units": False},
-        {"name": "Поиск материала", "has_units": False}, 
-        {"name": "Покупка материала + доставка", "has_units": False},
-        {"name": "Подготовка материала (порезка/торцовка)", "has_units": True},
-        {"name": "Изготовление", "has_units": True},
-        {"name": "Проверка ОТК", "has_units": True},
-        {"name": "Упаковка", "has_units": True},
-        {"name": "Отгрузка", "has_units": True}
-    ]
-    
-    stages = []
-    for config in stages_config:
-        stage = ProductionStage(name=config["name"])
-        if config["has_units"]:
-            stage.completed_units = 0
-        stages.append(stage)
-    
-    return stages
+def create_default_stages(workflow_id: str = "standard", version: Optional[int] = None) -> List[ProductionStage]:
+    return [ProductionStage(code=code) for code in workflow_registry.get(workflow_id, version).codes]
 
-# Routes
-@api_router.post("/auth/register", response_model=User)
-async def register_user(user_data: UserCreate):
-    # Check if user exists
-    existing_user = await db.users.find_one({"username": user_data.username})
-    if existing_user:
-        raise HTTPException(status_code=400, detail="Username already exists")
-    
-    # Create user
-    hashed_password = hash_password(user_data.password)
-    user = User(username=user_data.username, role=user_data.role)
-    user_dict = user.dict()
-    user_dict['password'] = hashed_password
-    
-    await db.users.insert_one(user_dict)
-    return user
+# In-process cache with tag-based invalidation
+class LocalCache:
+    """Small TTL cache; entries are tagged so writes can drop every dependent entry"""
 
-@api_router.post("/auth/login", response_model=LoginResponse)
-async def login_user(login_data: UserLogin):
-    user_data = await db.users.find_one({"username": login_data.username})
-    if not user_data:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    hashed_password = hash_password(login_data.password)
-    if user_data['password'] != hashed_password:
-        raise HTTPException(status_code=401, detail="Invalid credentials")
-    
-    user = User(**user_data)
-    token = create_access_token(user.id, user.username, user.role)
-    
-    return LoginResponse(access_token=token, user=user)
+    def __init__(self, ttl: float = 30.0, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # key -> (expires_at, value, tags)
+        self._tags = {}  # tag -> set(keys)
 
-@api_router.get("/auth/me", response_model=User)
-async def get_current_user_info(current_user: User = Depends(get_current_user)):
-    return current_user
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            return None
+        return entry[1]
 
-@api_router.post("/orders", response_model=Order)
-async def create_order(
-    order_data: OrderCreate,
-    current_user: User = Depends(get_current_user)
-):
-    order = Order(
-        **order_data.dict(),
-        created_by=current_user.id,
-        stages=create_default_stages()
-    )
-    
-    order_dict = prepare_for_mongo(order.dict())
-    await db.orders.insert_one(order_dict)
-    return order
+    def set(self, key, value, tags=(), ttl: Optional[float] = None):
+        if len(self._entries) >= self.max_entries:
+            # Самая старая запись вытесняется первой (dict сохраняет порядок вставки)
+            self._drop(next(iter(self._entries)))
+        self._drop(key)
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value, tuple(tags))
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
 
-@api_router.get("/orders", response_model=List[Order])
-async def get_orders(current_user: User = Depends(get_current_user)):
-    orders = await db.orders.find().to_list(1000)
-    result = []
-    for order_data in orders:
-        parsed_order = parse_from_mongo(order_data)
-        order = Order(**parsed_order)
+    def invalidate(self, tag: str):
+        for key in list(self._tags.pop(tag, ())):
+            self._drop(key)
+        self._drop(tag)
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+# Cross-worker cache invalidation bus
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+class NullInvalidationTransport:
+    """Single-process transport: invalidations never leave the worker"""
+
+    async def start(self, deliver):
+        pass
+
+    async def send(self, keys: List[str]):
+        pass
+
+    async def stop(self):
+        pass
+
+class MongoCappedInvalidationTransport:
+    """Broadcasts invalidations through a capped collection read with a tailable cursor"""
+
+    def __init__(self, database, collection_name: str = 'cache_invalidations', size_bytes: int = 1024 * 1024):
+        self.database = database
+        self.collection_name = collection_name
+        self.size_bytes = size_bytes
+        self._task = None
+
+    async def start(self, deliver):
+        names = await self.database.list_collection_names(filter={'name': self.collection_name})
+        if not names:
+            try:
+                await self.database.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+            except CollectionInvalid:
+                pass  # другой воркер создал коллекцию одновременно
+        self._task = asyncio.create_task(self._tail(deliver))
+
+    async def _tail(self, deliver):
+        collection = self.database[self.collection_name]
+        # _id сообщений задают драйверы разных воркеров: в пределах секунды они не упорядочены по вставке,
+        # поэтому курсор после переподключения не фильтруется по _id. Он идёт по коллекции в порядке $natural,
+        # а уже обработанные сообщения пропускаются. Больше size_bytes / 64 сообщений коллекция не вмещает
+        seen, seen_order = set(), collections.deque()
         
-        # Filter sensitive data for employees
-        if current_user.role == UserRole.EMPLOYEE:
-            # Remove cost information
-            order_dict = order.dict()
-            order_dict['material_cost'] = 0
-            order_dict['hourly_rate_domestic'] = 0
-            order_dict['hourly_rate_foreign'] = 0
-            # Remove files for employees
-            order_dict['files'] = []
-            order = Order(**order_dict)
+        def remember(message_id) -> bool:
+            if message_id in seen:
+                return False
+            seen.add(message_id)
+            seen_order.append(message_id)
+            if len(seen_order) > self.size_bytes // 64:
+                seen.discard(seen_order.popleft())
+            return True
         
-        result.append(order)
-    return result
+        # Сообщения, появившиеся до старта воркера, не доставляются
+        async for message in collection.find({}, {'_id': 1}):
+            remember(message['_id'])
+        while True:
+            cursor = collection.find({}, cursor_type=CursorType.TAILABLE_AWAIT)
+            try:
+                while cursor.alive:
+                    async for message in cursor:
+                        if remember(message['_id']) and message.get('origin') != WORKER_ID:
+                            deliver(message.get('keys', []))
+                    await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Invalidation tail cursor failed: {e}")
+            await asyncio.sleep(1)
 
-@api_router.get("/orders/{order_id}", response_model=Order)
-async def get_order(order_id: str, current_user: User = Depends(get_current_user)):
-    order_data = await db.orders.find_one({"id": order_id})
-    if not order_data:
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    parsed_order = parse_from_mongo(order_data)
-    order = Order(**parsed_order)
-    
-    # Filter sensitive data for employees
-    if current_user.role == UserRole.EMPLOYEE:
-        order_dict = order.dict()
-        order_dict['material_cost'] = 0
-        order_dict['hourly_rate_domestic'] = 0
-        order_dict['hourly_rate_foreign'] = 0
-        order_dict['files'] = []
-        order = Order(**order_dict)
-    
-    return order
+    async def send(self, keys: List[str]):
+        await self.database[self.collection_name].insert_one({
+            'origin': WORKER_ID,
+            'keys': keys,
+            'ts': datetime.now(timezone.utc),
+        })
 
-@api_router.put("/orders/{order_id}", response_model=Order)
-async def update_order(
-    order_id: str,
-    order_update: OrderUpdate,
-    current_user: User = Depends(get_current_user)
-):
-    if current_user.role != UserRole.MANAGER:
-        raise HTTPException(status_code=403, detail="Only managers can update orders")
-    
-    update_data = {k: v for k, v in order_update.dict().items() if v is not None}
-    if not update_data:
-        raise HTTPException(status_code=400, detail="No update data provided")
-    
-    await db.orders.update_one({"id": order_id}, {"$set": update_data})
-    
-    order_data = await db.orders.find_one({"id": order_id})
-    if not order_data:
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    parsed_order = parse_from_mongo(order_data)
-    return Order(**parsed_order)
-
-def calculate_stage_percentage(stage_index: int, stage: dict, total_quantity: int, is_completed: bool = False) -> int:
-    """Рассчитывает процент выполнения этапа по новой логике"""
-    # Этапы 1-3: только 0% или 100%
-    if stage_index < 3:
-        return 100 if is_completed else 0
-    
-    # Этапы 4-8: рассчитываются по количеству деталей
-    completed_units = stage.get('completed_units', 0) or 0
-    if total_quantity > 0:
-        return min(100, round((completed_units / total_quantity) * 100))
-    return 0
-
-def update_previous_stages_with_units(stages: list, current_stage_index: int, total_quantity: int, current_stage_date: str = None):
-    """Обновляет предыдущие этапы при изменении количества в текущем этапе"""
-    # Работает только для этапов 4-8 (индексы 3-7)
-    if current_stage_index < 3:
-        return
-    
-    current_stage = stages[current_stage_index]
-    current_units = current_stage.get('completed_units', 0) or 0
-    
-    # Если количество больше 0, обновляем все предыдущие этапы с количеством (этапы 4-текущий)
-    if current_units > 0:
-        for i in range(3, current_stage_index):  # От этапа 4 до текущего (не включая)
-            if i < len(stages):
-                prev_stage = stages[i]
-                prev_units = prev_stage.get('completed_units', 0) or 0
-                
-                # Обновляем количество только если текущее количество больше
-                if current_units > prev_units:
-                    prev_stage['completed_units'] = current_units
-                    prev_stage['percentage'] = calculate_stage_percentage(i, prev_stage, total_quantity)
-                    
-                    # Автоматически переводим в статус "в работе" если было "ожидает"
-                    if prev_stage.get('status') == 'pending':
-                        prev_stage['status'] = 'in_progress'
-                    
-                    # Проставляем дату начала автоматически, если она не была установлена вручную
-                    if not prev_stage.get('start_date') and current_stage_date:
-                        prev_stage['start_date'] = current_stage_date
-
-def update_previous_status_stages(stages: list, current_stage_index: int, current_stage_status: str, current_stage_dates: dict):
-    """Обновляет предыдущие этапы (1-3) при завершении текущего этапа"""
-    # Работает только для первых 3 этапов (индексы 0-2)
-    if current_stage_index >= 3 or current_stage_status != 'completed':
-        return
-    
-    # Получаем даты текущего этапа
-    current_end_date = current_stage_dates.get('end_date')
-    current_start_date = current_stage_dates.get('start_date')
-    
-    # Автоматически завершаем все предыдущие этапы
-    for i in range(current_stage_index):  # От этапа 0 до текущего (не включая)
-        if i < len(stages):
-            prev_stage = stages[i]
-            
-            # Завершаем этап, если он еще не завершен
-            if prev_stage.get('status') != 'completed':
-                prev_stage['status'] = 'completed'
-                prev_stage['percentage'] = 100
-                
-                # Проставляем даты только если они не были установлены вручную
-                if not prev_stage.get('start_date'):
-                    prev_stage['start_date'] = current_start_date or current_end_date
-                
-                if not prev_stage.get('end_date'):
-                    prev_stage['end_date'] = current_end_date
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
 
-@api_router.put("/orders/{order_id}/stages/{stage_id}")
-async def update_stage(
-    order_id: str,
-    stage_id: str,
-    stage_update: StageUpdate,
-    current_user: User = Depends(get_current_user)
-):
-    order_data = await db.orders.find_one({"id": order_id})
-    if not order_data:
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    stages = order_data.get('stages', [])
-    stage_found = False
-    stage_index = -1
-    
-    # Найти и обновить этап
-    for i, stage in enumerate(stages):
-        if stage['id'] == stage_id:
-            stage_found = True
-            stage_index = i
-            update_data = {k: v for k, v in stage_update.dict().items() if v is not None}
-            
-            # Обновляем поля этапа
-            for key, value in update_data.items():
-                if isinstance(value, date):
-                    stage[key] = value.isoformat()
-                else:
-                    stage[key] = value
-            
-            # Рассчитываем процент выполнения
-            is_completed = stage.get('status') == 'completed'
-            total_quantity = order_data.get('quantity', 1)
-            
-            # Для этапов 1-3: только проверяем статус
-            if stage_index < 3:
-                stage['percentage'] = calculate_stage_percentage(stage_index, stage, total_quantity, is_completed)
-            else:
-                # Для этапов 4-8: рассчитываем по количеству деталей
-                stage['percentage'] = calculate_stage_percentage(stage_index, stage, total_quantity)
-                
-                # Автоматически переводим в статус "в работе" если внесено количество и статус был "ожидает"
-                current_units = stage.get('completed_units', 0) or 0
-                if current_units > 0:
-                    if stage.get('status') == 'pending':
-                        stage['status'] = 'in_progress'
-                    
-                    # Проставляем дату начала автоматически, если она не была установлена
-                    if not stage.get('start_date'):
-                        stage['start_date'] = date.today().isoformat()
-            
-            break
-    
-    if not stage_found:
-        raise HTTPException(status_code=404, detail="Stage not found")
-    
-    # Обновляем предыдущие этапы
-    if stage_index < 3:
-        # Для первых 3 этапов: завершаем предыдущие этапы при завершении текущего
-        stage_data = stages[stage_index]
-        update_previous_status_stages(stages, stage_index, stage_data.get('status'), {
-            'start_date': stage_data.get('start_date'),
-            'end_date': stage_data.get('end_date')
-        })
-    else:
-        # Для этапов 4-8: обновляем количество в предыдущих этапах
-        current_stage_data = stages[stage_index]
-        current_date = current_stage_data.get('start_date')
-        update_previous_stages_with_units(stages, stage_index, order_data.get('quantity', 1), current_date)
-    
-    await db.orders.update_one({"id": order_id}, {"$set": {"stages": stages}})
-    return {"message": "Stage updated successfully"}
+class UnixSocketInvalidationTransport:
+    """Broadcasts invalidations as datagrams to every worker socket in a shared directory"""
 
-@api_router.post("/orders/{order_id}/files")
-async def upload_file(
-    order_id: str,
-    file: UploadFile = File(...),
-    current_user: User = Depends(get_current_user)
-):
-    if current_user.role != UserRole.MANAGER:
-        raise HTTPException(status_code=403, detail="Only managers can upload files")
-    
-    # Check if order exists
-    order_data = await db.orders.find_one({"id": order_id})
-    if not order_data:
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    # Generate unique filename
-    file_id = str(uuid.uuid4())
-    file_extension = Path(file.filename).suffix
-    unique_filename = f"{file_id}{file_extension}"
-    file_path = UPLOAD_DIR / unique_filename
-    
-    # Save file
-    async with aiofiles.open(file_path, 'wb') as f:
-        content = await file.read()
-        await f.write(content)
-    
-    # Create file info
-    file_info = FileInfo(
-        id=file_id,
-        filename=unique_filename,
-        original_filename=file.filename,
-        file_path=str(file_path)
-    )
-    
-    # Add file to order
-    await db.orders.update_one(
-        {"id": order_id},
-        {"$push": {"files": file_info.dict()}}
-    )
-    
-    return {"message": "File uploaded successfully", "file_id": file_id}
+    def __init__(self, socket_dir: Path):
+        self.socket_dir = Path(socket_dir)
+        self.path = self.socket_dir / f"{WORKER_ID}.sock"
+        self._sock = None
 
-@api_router.get("/orders/{order_id}/files/{file_id}")
-async def download_file(
-    order_id: str,
-    file_id: str,
-    current_user: User = Depends(get_current_user)
-):
-    if current_user.role != UserRole.MANAGER:
-        raise HTTPException(status_code=403, detail="Only managers can download files")
-    
-    order_data = await db.orders.find_one({"id": order_id})
-    if not order_data:
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    # Find file
-    file_info = None
-    for file_data in order_data.get('files', []):
-        if file_data['id'] == file_id:
-            file_info = file_data
-            break
-    
-    if not file_info:
-        raise HTTPException(status_code=404, detail="File not found")
-    
-    file_path = Path(file_info['file_path'])
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="File does not exist on disk")
-    
-    return FileResponse(
-        path=file_path,
-        filename=file_info['original_filename'],
-        media_type='application/octet-stream'
-    )
+    async def start(self, deliver):
+        self.socket_dir.mkdir(parents=True, exist_ok=True)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(str(self.path))
+        self._sock.setblocking(False)
 
-@api_router.delete("/orders/{order_id}")
-async def delete_order(
-    order_id: str,
-    current_user: User = Depends(get_current_user)
-):
-    if current_user.role != UserRole.MANAGER:
-        raise HTTPException(status_code=403, detail="Only managers can delete orders")
-    
-    result = await db.orders.delete_one({"id": order_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Order not found")
-    
-    return {"message": "Order deleted successfully"}
+        def on_readable():
+            while True:
+                try:
+                    payload = self._sock.recv(65536)
+                except (BlockingIOError, OSError):
+                    return
+                try:
+                    deliver(json.loads(payload.decode()))
+                except ValueError:
+                    logger.warning("Dropped malformed invalidation datagram")
 
-# Include router
-app.include_router(api_router)
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), on_readable)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+    async def send(self, keys: List[str]):
+        payload = json.dumps(keys).encode()
+        for peer in self.socket_dir.glob('*.sock'):
+            if peer == self.path:
+                continue
+            try:
+                self._sock.sendto(payload, str(peer))
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Сокет остался от завершившегося воркера
+                peer.unlink(missing_ok=True)
+            except BlockingIOError:
+                logger.warning(f"Invalidation queue of {peer.name} is full, message dropped")
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+    async def stop(self):
+        if self._sock:
+            asyncio.get_running_loop().remove_reader(self._sock.fileno())
+            self._sock.close()
+            self.path.unlink(missing_ok=True)
+
+class InvalidationBus:
+    """Publishes cache keys on write and applies them to every subscribed local cache"""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def _deliver(self, keys: List[str]):
+        for key in keys:
+            for callback in self._subscribers:
+                callback(key)
+
+    async def publish(self, *keys: str):
+        keys = list(keys)
+        self._deliver(keys)
+        try:
+            await self.transport.send(keys)
+        except Exception as e:
+            logger.error(f"Failed to broadcast cache invalidation {keys}: {e}")
+
+    async def start(self):
+        await self.transport.start(self._deliver)
+
+    async def stop(self):
+        await self.transport.stop()
+
+def create_invalidation_transport():
+    transport = os.environ.get('CACHE_BUS_TRANSPORT', 'none').lower()
+    if transport == 'mongo':
+        return MongoCappedInvalidationTransport(db)
+    if transport == 'unix':
+        return UnixSocketInvalidationTransport(Path(os.environ.get('CACHE_BUS_SOCKET_DIR', '/tmp/brauding-cache-bus')))
+    return NullInvalidationTransport()
+
+invalidation_bus = InvalidationBus(create_invalidation_transport())
+user_cache = LocalCache(ttl=float(os.environ.get('USER_CACHE_TTL', '60')))
+invalidation_bus.subscribe(user_cache.invalidate)
+
+# Stage definition registry
+class StageDefinition(BaseModel):
+    code: str
+    name: str
+    has_units: bool = False
+    position: int
+
+DEFAULT_STAGE_DEFINITIONS = [
+    StageDefinition(code="intake", name="Получение заказа на оценку", position=0),
+    StageDefinition(code="material_search", name="Поиск материала", position=1),
+    StageDefinition(code="material_purchase", name="Покупка материала + доставка", position=2),
+    StageDefinition(code="material_prep", name="Подготовка материала (порезка/торцовка)", has_units=True, position=3),
+    StageDefinition(code="manufacturing", name="Изготовление", has_units=True, position=4),
+    StageDefinition(code="qc", name="Проверка ОТК", has_units=True, position=5),
+    StageDefinition(code="packing", name="Упаковка", has_units=True, position=6),
+    StageDefinition(code="shipping", name="Отгрузка", has_units=True, position=7),
+]
+
+class StageRegistry:
+    """Stage definitions cached in-process; documents store only the stage code"""
+
+    def __init__(self, definitions: List[StageDefinition]):
+        self._set(definitions)
+
+    def _set(self, definitions: List[StageDefinition]):
+        self.definitions = sorted(definitions, key=lambda d: d.position)
+        self.by_code = {d.code: d for d in self.definitions}
+        self.by_name = {d.name: d for d in self.definitions}
+
+    def get(self, code: str) -> Optional[StageDefinition]:
+        return self.by_code.get(code)
+
+    def code_for(self, stage: dict) -> Optional[str]:
+        """Stage code of a stored stage, including legacy stages that only carry the name"""
+        if stage.get('code'):
+            return stage['code']
+        definition = self.by_name.get(stage.get('name'))
+        return definition.code if definition else None
+
+    async def seed(self):
+        # Значения по умолчанию добавляются, но не перезаписывают отредактированные в базе
+        for definition in DEFAULT_STAGE_DEFINITIONS:
+            await db.stage_definitions.update_one(
+                {'code': definition.code}, {'$setOnInsert': definition.dict()}, upsert=True
+            )
+
+    async def load(self):
+        self._set([StageDefinition(**doc) async for doc in db.stage_definitions.find()])
+
+    def invalidate(self, key: str):
+        if key == 'stage_definitions':
+            asyncio.ensure_future(self.load())
+
+stage_registry = StageRegistry(DEFAULT_STAGE_DEFINITIONS)
+invalidation_bus.subscribe(stage_registry.invalidate)
+
+def compact_stage(stage: dict) -> dict:
+    """Storage form of a stage: the code instead of name and UUID, without empty fields"""
+    code = stage_registry.code_for(stage)
+    if code is None:
+        # Этап вне реестра хранится как есть, чтобы не потерять данные
+        return stage
+    return {
+        'code': code,
+        **{key: value for key, value in stage.items() if key not in ('id', 'name', 'code') and value is not None},
+    }
+
+# Workflow engine
+class WorkflowStage(BaseModel):
+    code: str
+    depends_on: List[str] = []  # этапы, которые предшествуют этому
+
+class Workflow(BaseModel):
+    id: str
+    version: int = 1  # каждое изменение маршрута создаёт новую версию; заказы ссылаются на свою
+    name: str
+    applies_to: List[ProcessingType] = []  # выбирается автоматически для заказов с этими видами обработки
+    stages: List[WorkflowStage]
+
+def linear_workflow(workflow_id: str, name: str, codes: List[str]) -> Workflow:
+    return Workflow(id=workflow_id, name=name, stages=[
+        WorkflowStage(code=code, depends_on=[codes[i - 1]] if i else []) for i, code in enumerate(codes)
+    ])
+
+DEFAULT_WORKFLOW_ID = "standard"
+DEFAULT_WORKFLOWS = [
+    linear_workflow(DEFAULT_WORKFLOW_ID, "Стандартный маршрут", [d.code for d in DEFAULT_STAGE_DEFINITIONS]),
+]
+
+class StageKind(str, Enum):
+    BINARY = "binary"  # только 0% или 100%
+    UNITS = "units"  # процент по количеству обработанных деталей
+
+class CompiledWorkflow:
+    """Workflow compiled into a transition table: stage kind and cascade targets per stage"""
+
+    def __init__(self, workflow: Workflow, registry: StageRegistry):
+        self.workflow = workflow
+        self.codes = [stage.code for stage in workflow.stages]
+        self.position = {code: i for i, code in enumerate(self.codes)}
+        if len(self.position) != len(self.codes):
+            raise ValueError(f"Workflow {workflow.id} lists a stage twice")
+        self.kinds = []
+        for code in self.codes:
+            definition = registry.get(code)
+            if definition is None:
+                raise ValueError(f"Workflow {workflow.id} uses unknown stage {code}")
+            self.kinds.append(StageKind.UNITS if definition.has_units else StageKind.BINARY)
+
+        # Каскад идёт на все транзитивно предшествующие этапы того же вида.
+        # Зависимости могут ссылаться только на этапы выше по списку, поэтому граф ацикличен
+        ancestors = []
+        for i, stage in enumerate(workflow.stages):
+            closure = set()
+            for dependency in stage.depends_on:
+                j = self.position.get(dependency)
+                if j is None or j >= i:
+                    raise ValueError(f"Stage {stage.code} in workflow {workflow.id} must depend on an earlier stage")
+                closure.add(j)
+                closure |= ancestors[j]
+            ancestors.append(closure)
+        self.cascade_targets = [
+            tuple(sorted(j for j in ancestors[i] if self.kinds[j] == self.kinds[i])) for i in range(len(self.codes))
+        ]
+
+    def percentage(self, index: int, stage: dict, quantity: int) -> int:
+        if self.kinds[index] == StageKind.BINARY:
+            return 100 if stage.get('status') == StageStatus.COMPLETED.value else 0
+        completed_units = stage.get('completed_units', 0) or 0
+        if quantity > 0:
+            return min(100, round((completed_units / quantity) * 100))
+        return 0
+
+    def apply(self, stages: List[dict], index: int, quantity: int, today: datetime) -> tuple:
+        """Recalculate an updated stage and cascade to its predecessors.
+
+        `stages` is ordered by this workflow and is modified in place. Returns Mongo update
+        operators for the fields this method changed: ($set, $max). Fields the caller changed
+        on the updated stage are not included, the caller writes them itself."""
+        set_ops = {}
+        max_ops = {}
+        stage = stages[index]
+        percentage = self.percentage(index, stage, quantity)
+        if stage.get('percentage') != percentage:
+            stage['percentage'] = percentage
+            set_ops[f'stages.{index}.percentage'] = percentage
+
+        if self.kinds[index] == StageKind.UNITS:
+            units = stage.get('completed_units', 0) or 0
+            if units > 0:
+                # Автоматически переводим в статус "в работе" и проставляем дату начала
+                if stage.get('status') == StageStatus.PENDING.value:
+                    stage['status'] = StageStatus.IN_PROGRESS.value
+                    set_ops[f'stages.{index}.status'] = stage['status']
+                if not stage.get('start_date'):
+                    stage['start_date'] = today
+                    set_ops[f'stages.{index}.start_date'] = today
+                for j in self.cascade_targets[index]:
+                    previous = stages[j]
+                    if units <= (previous.get('completed_units', 0) or 0):
+                        continue
+                    previous['completed_units'] = units
+                    previous['percentage'] = self.percentage(j, previous, quantity)
+                    # $max: параллельные операторы на разных этапах не откатывают счётчики друг друга
+                    max_ops[f'stages.{j}.completed_units'] = units
+                    max_ops[f'stages.{j}.percentage'] = previous['percentage']
+                    if previous.get('status') == StageStatus.PENDING.value:
+                        previous['status'] = StageStatus.IN_PROGRESS.value
+                        set_ops[f'stages.{j}.status'] = previous['status']
+                    if not previous.get('start_date') and stage.get('start_date'):
+                        previous['start_date'] = stage['start_date']
+                        set_ops[f'stages.{j}.start_date'] = previous['start_date']
+        elif stage.get('status') == StageStatus.COMPLETED.value:
+            start_date = stage.get('start_date') or stage.get('end_date')
+            for j in self.cascade_targets[index]:
+                previous = stages[j]
+                if previous.get('status') == StageStatus.COMPLETED.value:
+                    continue
+                previous['status'] = StageStatus.COMPLETED.value
+                previous['percentage'] = 100
+                set_ops[f'stages.{j}.status'] = previous['status']
+                set_ops[f'stages.{j}.percentage'] = 100
+                # Даты проставляются только если они не были установлены вручную
+                if not previous.get('start_date') and start_date:
+                    previous['start_date'] = start_date
+                    set_ops[f'stages.{j}.start_date'] = start_date
+                if not previous.get('end_date') and stage.get('end_date'):
+                    previous['end_date'] = stage['end_date']
+                    set_ops[f'stages.{j}.end_date'] = stage['end_date']
+        return set_ops, max_ops
+
+class WorkflowRegistry:
+    """Versioned workflow definitions from db.workflows, compiled once and cached.
+
+    A stored version is never modified: orders keep the version their stages were created
+    from, so editing a routing only affects orders created afterwards."""
+
+    def __init__(self, workflows: List[Workflow]):
+        self._set(workflows)
+
+    def _set(self, workflows: List[Workflow]):
+        self.versions = {(workflow.id, workflow.version): workflow for workflow in workflows}
+        self.workflows = {}  # id -> последняя версия
+        for workflow in sorted(workflows, key=lambda w: w.version):
+            self.workflows[workflow.id] = workflow
+        self._compiled = {}
+
+    def get(self, workflow_id: Optional[str], version: Optional[int] = None) -> CompiledWorkflow:
+        """A specific version of a workflow, or its latest version"""
+        workflow_id = workflow_id or DEFAULT_WORKFLOW_ID
+        if version is None:
+            latest = self.workflows.get(workflow_id)
+            if latest is None:
+                raise ValueError(f"Unknown workflow: {workflow_id}")
+            version = latest.version
+        compiled = self._compiled.get((workflow_id, version))
+        if compiled is None:
+            workflow = self.versions.get((workflow_id, version))
+            if workflow is None:
+                raise ValueError(f"Unknown workflow: {workflow_id} v{version}")
+            compiled = self._compiled[(workflow_id, version)] = CompiledWorkflow(workflow, stage_registry)
+        return compiled
+
+    def for_order(self, order_data: dict) -> CompiledWorkflow:
+        # Заказы, созданные до версионирования, относятся к первой версии маршрута
+        return self.get(order_data.get('workflow'), order_data.get('workflow_version') or 1)
+
+    def select(self, processing_types: List[ProcessingType]) -> str:
+        for workflow in self.workflows.values():
+            if workflow.applies_to and set(workflow.applies_to) & set(processing_types):
+                return workflow.id
+        return DEFAULT_WORKFLOW_ID
+
+    async def seed(self):
+        for workflow in DEFAULT_WORKFLOWS:
+            await db.workflows.update_one({'id': workflow.id}, {'$setOnInsert': workflow.dict()}, upsert=True)
+        await db.workflows.update_many({'version': {'$exists': False}}, {'$set': {'version': 1}})
+        await db.workflows.create_index([('id', 1), ('version', 1)], unique=True)
+
+    async def load(self):
+        self._set([Workflow(**doc) async for doc in db.workflows.find()])
+
+    def invalidate(self, key: str):
+        if key == 'workflows':
+            asyncio.ensure_future(self.load())
+        elif key == 'stage_definitions':
+            # Вид этапа берётся из реестра определений
+            self._compiled = {}
+
+workflow_registry = WorkflowRegistry(DEFAULT_WORKFLOWS)
+invalidation_bus.subscribe(workflow_registry.invalidate)
+
+REGISTRY_RELOAD_INTERVAL = float(os.environ.get('REGISTRY_RELOAD_INTERVAL', '60'))
+
+class RegistryReloader:
+    """Periodically reloads stage definitions and workflows.
+
+    The invalidation bus reloads them immediately, but only reaches other workers with a
+    real CACHE_BUS_TRANSPORT; the periodic reload bounds how long a worker can lag behind."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await stage_registry.load()
+                await workflow_registry.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Registry reload failed: {e}")
+
+    async def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+registry_reloader = RegistryReloader(REGISTRY_RELOAD_INTERVAL)
+
+# Order revisions for delta sync
+SYNC_SETTLE_SECONDS = float(os.environ.get('SYNC_SETTLE_SECONDS', '2'))
+TOMBSTONE_TTL_DAYS = int(os.environ.get('TOMBSTONE_TTL_DAYS', '30'))
+TOMBSTONE_PRUNE_INTERVAL = float(os.environ.get('TOMBSTONE_PRUNE_INTERVAL', '3600'))
+
+async def next_revision(count: int = 1) -> int:
+    """Allocate `count` consecutive revisions and return the last one"""
+    counter = await db.counters.find_one_and_update(
+        {'_id': 'orders_revision'},
+        {'$inc': {'value': count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return counter['value']
+
+def settled_revision(since: int, events: List[tuple]) -> int:
+    """How far a revision cursor may advance over (revision, updated_at) changes.
+
+    A revision is allocated before its write lands, so a concurrent write with a lower
+    revision can still appear. The cursor only passes changes older than SYNC_SETTLE_SECONDS;
+    newer ones are read again next time (consumers must apply them idempotently)."""
+    settled_before = datetime.now(timezone.utc).timestamp() - SYNC_SETTLE_SECONDS
+    cursor = since
+    for revision, updated_at in sorted(events, key=lambda event: event[0]):
+        if updated_at is None:
+            break
+        if updated_at.timestamp() > settled_before:
+            break
+        cursor = revision
+    return cursor
+
+async def revision_stamp() -> dict:
+    """Fields to $set on every order write so delta sync can pick the order up"""
+    return {'revision': await next_revision(), 'updated_at': datetime.now(timezone.utc)}
+
+async def record_tombstones(order_ids: List[str], reason: str = 'deleted'):
+    if not order_ids:
+        return
+    last = await next_revision(len(order_ids))
+    now = datetime.now(timezone.utc)
+    await db.order_tombstones.bulk_write([
+        ReplaceOne(
+            {'id': order_id},
+            {'id': order_id, 'reason': reason, 'revision': last - len(order_ids) + 1 + i, 'updated_at': now},
+            upsert=True,
+        )
+        for i, order_id in enumerate(order_ids)
+    ], ordered=False)
+
+class TombstoneRetention:
+    """Expires tombstones after TOMBSTONE_TTL_DAYS and remembers the newest expired revision.
+
+    A client whose cursor is below that horizon may have missed deletions and must resync
+    from since=0. Pruning is done here rather than by a TTL index so the horizon is raised
+    before the tombstones disappear."""
+
+    def __init__(self, ttl_days: int, prune_interval: float):
+        self.ttl_days = ttl_days
+        self.prune_interval = prune_interval
+        self._pruned_at = 0.0
+
+    async def prune(self) -> int:
+        cutoff = datetime.fromtimestamp(time.time() - self.ttl_days * 86400, timezone.utc)
+        newest = await db.order_tombstones.find_one({'updated_at': {'$lt': cutoff}}, sort=[('revision', -1)])
+        self._pruned_at = time.monotonic()
+        if newest is None:
+            return 0
+        await db.counters.update_one(
+            {'_id': 'sync_horizon'}, {'$max': {'value': newest['revision']}}, upsert=True
+        )
+        result = await db.order_tombstones.delete_many(
+            {'updated_at': {'$lt': cutoff}, 'revision': {'$lte': newest['revision']}}
+        )
+        return result.deleted_count
+
+    async def horizon(self) -> int:
+        if time.monotonic() - self._pruned_at > self.prune_interval:
+            await self.prune()
+        counter = await db.counters.find_one({'_id': 'sync_horizon'})
+        return counter['value'] if counter else 0
+
+tombstone_retention = TombstoneRetention(TOMBSTONE_TTL_DAYS, TOMBSTONE_PRUNE_INTERVAL)
+
+async def ensure_sync_indexes():
+    await db.orders.create_index('revision')
+    await db.order_tombstones.create_index('id', unique=True)
+    await db.order_tombstones.create_index('revision')
+    # Раньше надгробия удалял TTL-индекс, не сдвигая горизонт синхронизации
+    indexes = await db.order_tombstones.index_information()
+    if 'expireAfterSeconds' in indexes.get('updated_at_1', {}):
+        await db.order_tombstones.drop_index('updated_at_1')
+    await db.order_tombstones.create_index('updated_at')
+    await tombstone_retention.prune()
+    await backfill_revisions()
+
+async def backfill_revisions(batch_size: int = 1000):
+    """Assign revisions to orders created before delta sync existed"""
+    while True:
+        batch = await db.orders.find({'revision': {'$exists': False}}, {'id': 1}).to_list(batch_size)
+        if not batch:
+            return
+        last = await next_revision(len(batch))
+        now = datetime.now(timezone.utc)
+        await db.orders.bulk_write([
+            UpdateOne({'id': order['id'], 'revision': {'$exists': False}},
+                      {'$set': {'revision': last - len(batch) + 1 + i, 'updated_at': now}})
+            for i, order in enumerate(batch)
+        ], ordered=False)
+
+# Conditional GET
+def etag_matches(request: Request, etag: str) -> bool:
+    """Weak comparison of If-None-Match against an ETag (RFC 9110 §13.1.2)"""
+    header = request.headers.get('if-none-match')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+def set_etag_headers(response: Response, etag: str):
+    response.headers['ETag'] = etag
+    # Представление зависит от роли пользователя, поэтому кеши различают его по токену
+    response.headers['Vary'] = 'Authorization'
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+def not_modified(etag: str) -> Response:
+    response = Response(status_code=304)
+    set_etag_headers(response, etag)
+    return response
+
+def order_etag(order_data: dict, role: UserRole) -> str:
+    archived = '-archived' if order_data.get('archived_at') else ''
+    return f'"order-{order_data["id"]}-{order_data.get("revision", 0)}{archived}-{role.value}"'
+
+ORDER_VERSION_PROJECTION = {'_id': 0, 'id': 1, 'revision': 1, 'archived_at': 1}
+
+def orders_collection_etag(role: UserRole, versions: List[dict], *params) -> str:
+    """Weak ETag of an order-list view, built from the (id, revision) of exactly the orders it returns.
+
+    The global revision counter is not usable here: a revision is allocated before its write
+    lands, so a read in between would pair the new counter with old documents."""
+    digest = hashlib.md5('-'.join(str(param) for param in params).encode())
+    for version in versions:
+        archived = 'a' if version.get('archived_at') else ''
+        digest.update(f"{version['id']}:{version.get('revision', 0)}{archived};".encode())
+    return f'W/"orders-{role.value}-{digest.hexdigest()[:20]}"'
+
+# Order number allocation
+ORDER_NUMBER_FORMAT = os.environ.get('ORDER_NUMBER_FORMAT', '{prefix}{year}-{seq:05d}')
+ORDER_NUMBER_PREFIXES = json.loads(os.environ.get('ORDER_NUMBER_PREFIXES', '{"domestic": "UA-", "foreign": "EX-"}'))
+ORDER_NUMBER_BLOCK_SIZE = int(os.environ.get('ORDER_NUMBER_BLOCK_SIZE', '1'))
+
+class OrderNumberAllocator:
+    """Order numbers from atomic per-year/per-market counters, reserved in blocks per worker.
+
+    With a block size above 1 numbers stay unique but may have gaps (a block reserved by a
+    worker that stops is never used)."""
+
+    def __init__(self, block_size: int):
+        self.block_size = max(1, block_size)
+        self._blocks = {}  # counter id -> [next, last]
+        self._locks = {}
+
+    async def _reserve(self, counter_id: str, count: int) -> int:
+        """Reserve `count` numbers in one round trip; returns the first one"""
+        counter = await db.counters.find_one_and_update(
+            {'_id': counter_id},
+            {'$inc': {'value': count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter['value'] - count + 1
+
+    async def allocate(self, market_type: MarketType, count: int = 1) -> List[str]:
+        year = datetime.now(timezone.utc).year
+        counter_id = f"order_number:{year}:{market_type.value}"
+        lock = self._locks.setdefault(counter_id, asyncio.Lock())
+        async with lock:
+            block = self._blocks.get(counter_id)
+            available = block[1] - block[0] + 1 if block else 0
+            if available >= count:
+                first = block[0]
+                block[0] += count
+            else:
+                # Остаток старого блока не используется, чтобы номера одной партии шли подряд
+                reserve = max(count, self.block_size)
+                first = await self._reserve(counter_id, reserve)
+                self._blocks[counter_id] = [first + count, first + reserve - 1]
+        prefix = ORDER_NUMBER_PREFIXES.get(market_type.value, '')
+        return [ORDER_NUMBER_FORMAT.format(prefix=prefix, year=year, seq=seq) for seq in range(first, first + count)]
+
+order_numbers = OrderNumberAllocator(ORDER_NUMBER_BLOCK_SIZE)
+
+async def ensure_order_number_index():
+    try:
+        await db.orders.create_index('order_number', unique=True)
+    except OperationFailure as e:
+        # Старые данные могут содержать дубликаты; их нужно разрешить вручную
+        logger.error(f"Cannot create unique order_number index: {e}")
+    # Уникальный индекс есть только у рабочей коллекции; архив проверяется при создании и импорте
+    await db[ARCHIVE_COLLECTION].create_index('order_number')
+
+async def archived_order_numbers(numbers: List[str]) -> List[str]:
+    """Which of the given client-supplied order numbers already belong to archived orders"""
+    if not numbers:
+        return []
+    return await db[ARCHIVE_COLLECTION].distinct('order_number', {'order_number': {'$in': numbers}})
+
+# Full-text search over orders
+SEARCH_COLLECTION = 'order_search'
+SEARCH_MAX_CANDIDATES = 1000
+SEARCH_INDEX_VERSION = 2  # увеличивается при изменении build_search_document — старые документы переиндексируются
+SEARCH_BACKFILL_BATCH_SIZE = 500
+
+def normalize_search_text(text: str) -> str:
+    text = (text or '').lower().replace('ё', 'е')
+    return ' '.join(re.findall(r'\w+', text))
+
+def text_trigrams(text: str) -> List[str]:
+    """Bigrams and trigrams of every word for indexing (one-character words are kept whole).
+
+    Bigrams let a two-character fragment of a longer part number match."""
+    grams = set()
+    for word in normalize_search_text(text).split():
+        if len(word) < 2:
+            grams.add(word)
+            continue
+        for size in (2, 3):
+            for i in range(len(word) - size + 1):
+                grams.add(word[i:i + size])
+    return sorted(grams)
+
+def query_grams(text: str) -> List[str]:
+    """Grams a search fragment must contain: trigrams of longer words, short words whole"""
+    grams = set()
+    for word in normalize_search_text(text).split():
+        if len(word) < 3:
+            grams.add(word)
+            continue
+        for i in range(len(word) - 2):
+            grams.add(word[i:i + 3])
+    return sorted(grams)
+
+def build_search_document(order_data: dict) -> dict:
+    notes = ' '.join(stage.get('notes') or '' for stage in order_data.get('stages', []))
+    fields = {
+        'order_number': normalize_search_text(order_data.get('order_number', '')),
+        'client_name': normalize_search_text(order_data.get('client_name', '')),
+        'description': normalize_search_text(order_data.get('description', '')),
+        'notes': normalize_search_text(notes),
+    }
+    return {
+        'order_id': order_data['id'],
+        'version': SEARCH_INDEX_VERSION,
+        'archived': order_data.get('archived_at') is not None,
+        **fields,
+        'trigrams': text_trigrams(' '.join(fields.values())),
+    }
+
+async def index_order_for_search(order_data: dict):
+    await db[SEARCH_COLLECTION].replace_one(
+        {'order_id': order_data['id']}, build_search_document(order_data), upsert=True
+    )
+
+async def ensure_search_indexes():
+    collection = db[SEARCH_COLLECTION]
+    await collection.create_index('order_id', unique=True)
+    await collection.create_index('trigrams')
+    await collection.create_index('archived')
+    # default_language 'none': без стемминга, одинаково для кириллицы и латиницы
+    await collection.create_index(
+        [('order_number', 'text'), ('client_name', 'text'), ('description', 'text'), ('notes', 'text')],
+        name='order_text',
+        default_language='none',
+        weights={'order_number': 10, 'client_name': 5, 'description': 2, 'notes': 1},
+    )
+    await backfill_search_index()
+
+async def backfill_search_index(rebuild: bool = False, batch_size: int = SEARCH_BACKFILL_BATCH_SIZE) -> int:
+    """Index orders without an up-to-date search document (created before search existed or
+    indexed by an older SEARCH_INDEX_VERSION); with `rebuild` every order is reindexed"""
+    collection = db[SEARCH_COLLECTION]
+    current = set()
+    if not rebuild:
+        current = {doc['order_id'] async for doc in collection.find({'version': SEARCH_INDEX_VERSION}, {'order_id': 1})}
+    projection = {'id': 1, 'order_number': 1, 'client_name': 1, 'description': 1, 'archived_at': 1, 'stages.notes': 1}
+    indexed = 0
+    for source in (db.orders, db[ARCHIVE_COLLECTION]):
+        batch = []
+        async for order_data in source.find({}, projection):
+            if order_data['id'] in current:
+                continue
+            batch.append(ReplaceOne(
+                {'order_id': order_data['id']}, build_search_document(order_data), upsert=True
+            ))
+            if len(batch) >= batch_size:
+                await collection.bulk_write(batch, ordered=False)
+                indexed += len(batch)
+                batch = []
+        if batch:
+            await collection.bulk_write(batch, ordered=False)
+            indexed += len(batch)
+    if indexed:
+        logger.info(f"Indexed {indexed} orders for search")
+    return indexed
+
+SEARCH_FIELD_WEIGHTS = {'order_number': 10, 'client_name': 5, 'description': 2, 'notes': 1}
+
+def partial_match_score(search_doc: dict, needle: str) -> float:
+    """Rank a trigram candidate by the weight of fields containing the fragment and how early it appears"""
+    score = 0.0
+    for field, weight in SEARCH_FIELD_WEIGHTS.items():
+        position = search_doc.get(field, '').find(needle)
+        if position >= 0:
+            score += weight * (1.0 + 1.0 / (1 + position))
+    return score
+
+async def search_order_ids(query: str, skip: int, limit: int, include_archived: bool = False) -> tuple:
+    """Returns (mode, total, [order_id]) — text index first, trigram partial match as fallback"""
+    collection = read_db('search')[SEARCH_COLLECTION]
+    scope = {} if include_archived else {'archived': {'$ne': True}}
+    text_filter = {'$text': {'$search': query}, **scope}
+    total = await collection.count_documents(text_filter)
+    if total:
+        cursor = collection.find(
+            text_filter, {'order_id': 1, 'score': {'$meta': 'textScore'}}
+        ).sort([('score', {'$meta': 'textScore'})]).skip(skip).limit(limit)
+        return 'text', total, [doc['order_id'] async for doc in cursor]
+
+    needle = normalize_search_text(query)
+    grams = query_grams(needle)
+    if not grams:
+        return 'partial', 0, []
+    candidates = await collection.find(
+        {'trigrams': {'$all': grams}, **scope},
+        {'order_id': 1, 'order_number': 1, 'client_name': 1, 'description': 1, 'notes': 1},
+    ).to_list(SEARCH_MAX_CANDIDATES)
+    scored = []
+    for doc in candidates:
+        score = partial_match_score(doc, needle)
+        if score > 0:
+            scored.append((score, doc['order_id']))
+    scored.sort(key=lambda item: -item[0])
+    return 'partial', len(scored), [order_id for _, order_id in scored[skip:skip + limit]]
+
+# Attachment storage
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # например MinIO: http://localhost:9000
+S3_REGION = os.environ.get('S3_REGION', 'us-east-1')
+S3_PRESIGN_EXPIRES = int(os.environ.get('S3_PRESIGN_EXPIRES', '300'))
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(200 * 1024 * 1024)))
+
+class LocalStorage:
+    """Attachments in UPLOAD_DIR on the API host"""
+
+    name = 'local'
+    supports_presigned = False
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    async def write(self, key: str, chunks):
+        async with aiofiles.open(self.path(key), 'wb') as f:
+            async for chunk in chunks:
+                await f.write(chunk)
+
+    async def put_file(self, key: str, source: Path):
+        await asyncio.to_thread(shutil.copyfile, source, self.path(key))
+
+    async def exists(self, key: str) -> bool:
+        return self.path(key).exists()
+
+    @asynccontextmanager
+    async def local_copy(self, key: str):
+        yield str(self.path(key))
+
+    def download_response(self, key: str, filename: str) -> Response:
+        return FileResponse(path=self.path(key), filename=filename, media_type='application/octet-stream')
+
+    async def delete(self, key: str):
+        self.path(key).unlink(missing_ok=True)
+
+class S3Storage:
+    """Attachments in an S3-compatible bucket; clients transfer bytes directly via presigned URLs"""
+
+    name = 's3'
+    supports_presigned = True
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str], region: str, expires: int):
+        self.bucket = bucket
+        self.expires = expires
+        self.client = boto3.client(
+            's3', endpoint_url=endpoint_url, region_name=region, config=BotoConfig(signature_version='s3v4')
+        )
+
+    async def write(self, key: str, chunks):
+        # boto3 синхронный: спулим во временный файл и загружаем в потоке (multipart для больших файлов)
+        with tempfile.NamedTemporaryFile(delete=False) as tmp:
+            tmp_path = Path(tmp.name)
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                async for chunk in chunks:
+                    await f.write(chunk)
+            await self.put_file(key, tmp_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    async def put_file(self, key: str, source: Path):
+        await asyncio.to_thread(self.client.upload_file, str(source), self.bucket, key)
+
+    async def exists(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(self.client.head_object, Bucket=self.bucket, Key=key)
+            return True
+        except BotoClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    @asynccontextmanager
+    async def local_copy(self, key: str):
+        with tempfile.NamedTemporaryFile(suffix=Path(key).suffix, delete=False) as tmp:
+            tmp_path = Path(tmp.name)
+        try:
+            await asyncio.to_thread(self.client.download_file, self.bucket, key, str(tmp_path))
+            yield str(tmp_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    def download_response(self, key: str, filename: str) -> Response:
+        url = self.client.generate_presigned_url(
+            'get_object',
+            Params={
+                'Bucket': self.bucket,
+                'Key': key,
+                'ResponseContentDisposition': f"attachment; filename*=UTF-8''{quote(filename)}",
+            },
+            ExpiresIn=self.expires,
+        )
+        return RedirectResponse(url, status_code=307)
+
+    def presigned_upload(self, key: str, content_type: str) -> dict:
+        return self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=key,
+            Fields={'Content-Type': content_type},
+            Conditions=[{'Content-Type': content_type}, ['content-length-range', 1, MAX_UPLOAD_BYTES]],
+            ExpiresIn=self.expires,
+        )
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.client.delete_object, Bucket=self.bucket, Key=key)
+
+def create_storages() -> dict:
+    storages = {'local': LocalStorage(UPLOAD_DIR)}
+    if S3_BUCKET:
+        storages['s3'] = S3Storage(S3_BUCKET, S3_ENDPOINT_URL, S3_REGION, S3_PRESIGN_EXPIRES)
+    if STORAGE_BACKEND not in storages:
+        raise RuntimeError(f"Storage backend {STORAGE_BACKEND} is not configured")
+    return storages
+
+storages = create_storages()
+default_storage = storages[STORAGE_BACKEND]
+
+def file_location(file_info: dict) -> tuple:
+    """(storage backend, object key) of an attachment, including files saved before storage backends existed"""
+    backend = storages.get(file_info.get('storage') or 'local')
+    if backend is None:
+        raise RuntimeError(f"Storage backend {file_info.get('storage')} is not configured")
+    return backend, file_info.get('storage_key') or Path(file_info['file_path']).name
+
+# Hot read coalescing
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '1.0'))
+
+class HotReadCache:
+    """Single-flight coalescing of identical reads plus an optional micro-TTL cache of rendered bodies"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.cache = LocalCache(ttl=ttl, max_entries=1000)
+        self._inflight = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def invalidate(self, tag: str):
+        # Вычисление, начатое до записи, не должно ни попасть в кеш, ни раздаваться новым запросам
+        self._generation += 1
+        self.cache.invalidate(tag)
+
+    async def get(self, key: tuple, compute, tags=('orders',)):
+        if self.ttl > 0:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+        flight_key = (key, self._generation)
+        flight = self._inflight.get(flight_key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            flight = asyncio.ensure_future(self._compute(key, compute, tags, self._generation))
+            self._inflight[flight_key] = flight
+            flight.add_done_callback(lambda _: self._inflight.pop(flight_key, None))
+        return await asyncio.shield(flight)
+
+    async def _compute(self, key: tuple, compute, tags, generation: int):
+        value = await compute()
+        if self.ttl > 0 and generation == self._generation:
+            self.cache.set(key, value, tags=tags)
+        return value
+
+    def stats(self) -> dict:
+        return {
+            'ttl': self.ttl,
+            'entries': len(self.cache._entries),
+            'inflight': len(self._inflight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
+
+hot_reads = HotReadCache(RESPONSE_CACHE_TTL)
+invalidation_bus.subscribe(hot_reads.invalidate)
+
+def render_json(data) -> bytes:
+    return json.dumps(jsonable_encoder(data), ensure_ascii=False).encode('utf-8')
+
+def cached_json_response(body: bytes, etag: str) -> Response:
+    response = Response(content=body, media_type='application/json')
+    set_etag_headers(response, etag)
+    return response
+
+# Background job queue
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '1.0'))
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', '2'))
+JOB_PROCESS_WORKERS = int(os.environ.get('JOB_PROCESS_WORKERS', '2'))
+JOB_LOCK_SECONDS = int(os.environ.get('JOB_LOCK_SECONDS', '300'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+def compute_file_metadata(file_path: str) -> dict:
+    """Hash and inspect an uploaded file (runs in the process pool)"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    content_type, _ = mimetypes.guess_type(file_path)
+    return {
+        'sha256': digest.hexdigest(),
+        'size': size,
+        'content_type': content_type or 'application/octet-stream',
+    }
+
+class JobQueue:
+    """Mongo-persisted job queue drained by a pool of asyncio consumers"""
+
+    def __init__(self, collection_name: str = 'jobs'):
+        self.collection_name = collection_name
+        self.handlers = {}
+        self.failure_hooks = {}
+        self.process_pool = None
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+
+    @property
+    def collection(self):
+        return db[self.collection_name]
+
+    def handler(self, kind: str):
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def on_failure(self, kind: str):
+        """Register a hook called once a job of this kind has exhausted its attempts"""
+        def register(func):
+            self.failure_hooks[kind] = func
+            return func
+        return register
+
+    async def enqueue(self, kind: str, payload: dict, job_id: Optional[str] = None) -> str:
+        job_id = job_id or str(uuid.uuid4())
+        await self.collection.insert_one({
+            'id': job_id,
+            'kind': kind,
+            'payload': payload,
+            'status': JobStatus.QUEUED.value,
+            'attempts': 0,
+            'created_at': datetime.now(timezone.utc),
+        })
+        self._wakeup.set()
+        return job_id
+
+    async def run_cpu(self, func, *args):
+        """Run a CPU-heavy function in the process pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.process_pool, func, *args)
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        # Задачи, зависшие в running после падения воркера, забираются повторно по истечении блокировки
+        return await self.collection.find_one_and_update(
+            {'$or': [
+                {'status': JobStatus.QUEUED.value},
+                {'status': JobStatus.RUNNING.value, 'locked_until': {'$lt': now}},
+            ]},
+            {
+                '$set': {
+                    'status': JobStatus.RUNNING.value,
+                    'started_at': now,
+                    'locked_by': WORKER_ID,
+                    'locked_until': datetime.fromtimestamp(now.timestamp() + JOB_LOCK_SECONDS, timezone.utc),
+                },
+                '$inc': {'attempts': 1},
+            },
+            sort=[('created_at', 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _run(self, job: dict):
+        handler = self.handlers.get(job['kind'])
+        try:
+            if handler is None:
+                raise ValueError(f"No handler for job kind {job['kind']}")
+            result = await handler(job['id'], job['payload'])
+            await self.collection.update_one({'id': job['id']}, {'$set': {
+                'status': JobStatus.DONE.value,
+                'result': result,
+                'finished_at': datetime.now(timezone.utc),
+            }})
+        except Exception as e:
+            logger.exception(f"Job {job['id']} ({job['kind']}) failed")
+            final = job.get('attempts', 1) >= JOB_MAX_ATTEMPTS or handler is None
+            await self.collection.update_one({'id': job['id']}, {'$set': {
+                'status': JobStatus.FAILED.value if final else JobStatus.QUEUED.value,
+                'error': str(e),
+                'finished_at': datetime.now(timezone.utc),
+            }})
+            if final and job['kind'] in self.failure_hooks:
+                await self.failure_hooks[job['kind']](job['id'], job['payload'], str(e))
+
+    async def _consume(self):
+        while True:
+            try:
+                job = await self._claim()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Job queue poll failed: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def start(self):
+        await self.collection.create_index('id', unique=True)
+        await self.collection.create_index([('status', 1), ('created_at', 1)])
+        # forkserver вместо fork: дочерний процесс не наследует потоки Motor, очереди логов и
+        # захваченные ими блокировки, поэтому не может зависнуть на блокировке, взятой в момент fork
+        self.process_pool = ProcessPoolExecutor(
+            max_workers=JOB_PROCESS_WORKERS, mp_context=multiprocessing.get_context('forkserver')
+        )
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(JOB_CONCURRENCY)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.process_pool:
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
+
+job_queue = JobQueue()
+
+# Attachment previews
+PREVIEW_DIR = Path(os.environ.get('PREVIEW_DIR', 'previews'))
+PREVIEW_DIR.mkdir(exist_ok=True)
+PREVIEW_CACHE_MAX_BYTES = int(os.environ.get('PREVIEW_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+PREVIEW_SIZES = (256, 512, 1024)
+PREVIEW_DEFAULT_SIZE = 512
+PREVIEW_IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/bmp', 'image/tiff', 'image/webp'}
+PREVIEW_PDF_TYPE = 'application/pdf'
+
+def is_previewable(content_type: Optional[str]) -> bool:
+    return content_type in PREVIEW_IMAGE_TYPES or content_type == PREVIEW_PDF_TYPE
+
+def render_preview(source_path: str, target_path: str, content_type: str, max_size: int):
+    """Render a downscaled JPEG of an image or the first PDF page (runs in the process pool)"""
+    from PIL import Image
+
+    if content_type == PREVIEW_PDF_TYPE:
+        import pypdfium2 as pdfium
+
+        document = pdfium.PdfDocument(source_path)
+        try:
+            page = document[0]
+            width, height = page.get_size()
+            image = page.render(scale=max_size / max(width, height)).to_pil()
+        finally:
+            document.close()
+    else:
+        image = Image.open(source_path)
+        # draft() lets the JPEG decoder downscale while decoding instead of loading full resolution
+        image.draft('RGB', (max_size, max_size))
+
+    image.thumbnail((max_size, max_size))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    tmp_path = f"{target_path}.{os.getpid()}.tmp"
+    image.save(tmp_path, 'JPEG', quality=80, optimize=True)
+    os.replace(tmp_path, target_path)
+
+class PreviewCache:
+    """On-disk preview cache keyed by file hash, evicted least-recently-used by total size"""
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._rendering = {}
+
+    def path_for(self, sha256: str, size: int) -> Path:
+        return self.directory / f"{sha256}-{size}.jpg"
+
+    def touch(self, path: Path):
+        # mtime служит отметкой последнего обращения для LRU
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+        for path in self.directory.glob('*.jpg'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    async def get_or_render(self, open_source, sha256: str, content_type: str, size: int) -> Path:
+        """`open_source()` returns an async context manager yielding a local path of the original"""
+        target = self.path_for(sha256, size)
+        if target.exists():
+            self.touch(target)
+            return target
+        # Одновременные запросы одного превью ждут единственный рендер
+        key = (sha256, size)
+        pending = self._rendering.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._render(open_source, target, content_type, size))
+            self._rendering[key] = pending
+            pending.add_done_callback(lambda _: self._rendering.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _render(self, open_source, target: Path, content_type: str, size: int) -> Path:
+        async with open_source() as source_path:
+            await job_queue.run_cpu(render_preview, source_path, str(target), content_type, size)
+        await asyncio.get_running_loop().run_in_executor(None, self.evict)
+        return target
+
+preview_cache = PreviewCache(PREVIEW_DIR, PREVIEW_CACHE_MAX_BYTES)
+
+async def set_file_fields(order_id: str, file_id: str, fields: dict):
+    await db.orders.update_one(
+        {"id": order_id, "files.id": file_id},
+        {"$set": {**{f"files.$.{key}": value for key, value in fields.items()}, **await revision_stamp()}}
+    )
+    await invalidation_bus.publish(f"order:{order_id}", "orders")
+
+@job_queue.handler('process_file')
+async def process_uploaded_file(job_id: str, payload: dict) -> dict:
+    await set_file_fields(payload['order_id'], payload['file_id'], {'status': FileStatus.PROCESSING.value})
+    backend, key = file_location(payload)
+    async with backend.local_copy(key) as local_path:
+        metadata = await job_queue.run_cpu(compute_file_metadata, local_path)
+    if is_previewable(metadata['content_type']):
+        # Превью по умолчанию готовится заранее, чтобы первое открытие заказа было быстрым
+        try:
+            await preview_cache.get_or_render(
+                lambda: backend.local_copy(key), metadata['sha256'], metadata['content_type'], PREVIEW_DEFAULT_SIZE
+            )
+        except Exception as e:
+            logger.warning(f"Preview rendering failed for file {payload['file_id']}: {e}")
+    await set_file_fields(payload['order_id'], payload['file_id'], {
+        **metadata,
+        'status': FileStatus.READY.value,
+        'processed_at': datetime.now(timezone.utc),
+    })
+    return metadata
+
+@job_queue.on_failure('process_file')
+async def process_file_failed(job_id: str, payload: dict, error: str):
+    await set_file_fields(payload['order_id'], payload['file_id'], {
+        'status': FileStatus.FAILED.value,
+        'processing_error': error,
+    })
+
+# Archive of shipped orders
+ARCHIVE_COLLECTION = 'orders_archive'
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '180'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '500'))
+SHIPPING_STAGE_CODE = "shipping"
+
+async def ensure_archive_collection():
+    names = await db.list_collection_names(filter={'name': ARCHIVE_COLLECTION})
+    if not names:
+        try:
+            # Архив читается редко, поэтому хранится с более сильным сжатием, чем горячая коллекция
+            await db.create_collection(
+                ARCHIVE_COLLECTION,
+                storageEngine={'wiredTiger': {'configString': 'block_compressor=zstd'}},
+            )
+        except CollectionInvalid:
+            pass
+    await db[ARCHIVE_COLLECTION].create_index('id', unique=True)
+
+def archivable_orders_filter(older_than_days: int) -> dict:
+    cutoff = date.fromordinal(date.today().toordinal() - older_than_days)
+    return {'stages': {'$elemMatch': {
+        'code': SHIPPING_STAGE_CODE,
+        'status': StageStatus.COMPLETED.value,
+        'end_date': {'$lt': to_bson_date(cutoff)},
+    }}}
+
+async def move_orders(source, target, query: dict, archived: bool, batch_size: int = ARCHIVE_BATCH_SIZE) -> tuple:
+    """Move matching orders between collections in batches; safe to re-run after an interruption.
+
+    Returns (number moved, ids left in the source because their order number is taken in the target)."""
+    moved = 0
+    conflicts = []
+    while True:
+        pending = {'$and': [query, {'id': {'$nin': conflicts}}]} if conflicts else query
+        batch = await source.find(pending).limit(batch_size).to_list(batch_size)
+        if not batch:
+            return moved, conflicts
+        requests = []
+        deletes = []
+        for order_data in batch:
+            order_data.pop('_id', None)
+            # Удаляется только скопированная версия: заказ, изменённый после чтения, остаётся в источнике
+            deletes.append(DeleteOne({'id': order_data['id'], 'revision': order_data.get('revision')}))
+            if archived:
+                order_data['archived_at'] = datetime.now(timezone.utc)
+            else:
+                order_data.pop('archived_at', None)
+                order_data.update(await revision_stamp())
+            requests.append(ReplaceOne({'id': order_data['id']}, order_data, upsert=True))
+        # Сначала записываем в целевую коллекцию, потом удаляем из исходной: при сбое заказ не теряется
+        try:
+            await target.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error.get('code') != 11000 for error in errors):
+                raise
+            # Номер заказа уже занят в целевой коллекции (уникальный индекс есть только у orders):
+            # такие заказы остаются на месте, остальные переносятся
+            failed = {error['index'] for error in errors}
+            conflicts += [batch[i]['id'] for i in failed]
+            batch = [order_data for i, order_data in enumerate(batch) if i not in failed]
+            deletes = [delete for i, delete in enumerate(deletes) if i not in failed]
+            if not batch:
+                continue
+        await source.bulk_write(deletes, ordered=False)
+        ids = [order_data['id'] for order_data in batch]
+        left = {doc['id'] async for doc in source.find({'id': {'$in': ids}}, {'_id': 0, 'id': 1})}
+        if left:
+            # Заказы, которые всё ещё подходят под условие, следующий проход скопирует заново поверх устаревшей копии;
+            # копии остальных из целевой коллекции убираются
+            matching = source.find({'$and': [query, {'id': {'$in': list(left)}}]}, {'_id': 0, 'id': 1})
+            stale = left - {doc['id'] async for doc in matching}
+            if stale:
+                await target.delete_many({'id': {'$in': list(stale)}})
+            ids = [order_id for order_id in ids if order_id not in left]
+        if not ids:
+            continue
+        if archived:
+            # Для синхронизации клиентов архивированный заказ выглядит как удалённый
+            await record_tombstones(ids, reason='archived')
+        else:
+            await db.order_tombstones.delete_many({'id': {'$in': ids}})
+        await db[SEARCH_COLLECTION].update_many({'order_id': {'$in': ids}}, {'$set': {'archived': archived}})
+        await invalidation_bus.publish("orders", *[f"order:{order_id}" for order_id in ids])
+        moved += len(ids)
+
+@job_queue.handler('archive_orders')
+async def archive_orders_job(job_id: str, payload: dict) -> dict:
+    archived, _ = await move_orders(
+        db.orders, db[ARCHIVE_COLLECTION], archivable_orders_filter(payload['older_than_days']), archived=True
+    )
+    logger.info(f"Archived {archived} shipped orders")
+    return {'archived': archived}
+
+@job_queue.handler('reindex_search')
+async def reindex_search_job(job_id: str, payload: dict) -> dict:
+    return {'indexed': await backfill_search_index(rebuild=True)}
+
+# Throughput rollups
+ROLLUP_COLLECTION = 'throughput_daily'
+
+def stage_progress_deltas(before: List[dict], after: List[dict]) -> List[tuple]:
+    """(stage index, units delta, completions delta) for every stage whose progress changed"""
+    deltas = []
+    for i, (old, new) in enumerate(zip(before, after)):
+        units = (new.get('completed_units') or 0) - (old.get('completed_units') or 0)
+        was_completed = old.get('status') == StageStatus.COMPLETED.value
+        is_completed = new.get('status') == StageStatus.COMPLETED.value
+        completions = int(is_completed) - int(was_completed)
+        if units or completions:
+            deltas.append((i, units, completions))
+    return deltas
+
+async def record_throughput(order_data: dict, before: List[dict], after: List[dict]):
+    """Fold a stage change into day × stage × processing type × responsible person counters"""
+    deltas = stage_progress_deltas(before, after)
+    if not deltas:
+        return
+    day = to_bson_date(date.today())
+    # Заказ с несколькими видами обработки учитывается в каждом из них
+    processing_types = order_data.get('processing_types') or ['none']
+    requests = []
+    for index, units, completions in deltas:
+        stage = after[index]
+        for processing_type in processing_types:
+            requests.append(UpdateOne(
+                {
+                    'day': day,
+                    'stage': stage_registry.code_for(stage) or stage.get('name'),
+                    'processing_type': processing_type,
+                    'responsible_person': stage.get('responsible_person') or '',
+                },
+                {'$inc': {'units': units, 'completions': completions, 'updates': 1}},
+                upsert=True,
+            ))
+    try:
+        await db[ROLLUP_COLLECTION].bulk_write(requests, ordered=False)
+    except Exception as e:
+        # Отчётность не должна ломать обновление этапа
+        logger.error(f"Failed to record throughput for order {order_data.get('id')}: {e}")
+
+async def ensure_rollup_indexes():
+    await db[ROLLUP_COLLECTION].create_index(
+        [('day', 1), ('stage', 1), ('processing_type', 1), ('responsible_person', 1)], unique=True
+    )
+
+# Stage unit counters
+COUNTER_FLUSH_INTERVAL = float(os.environ.get('COUNTER_FLUSH_INTERVAL_MS', '0')) / 1000
+COUNTER_SHUTDOWN_RETRIES = 3
+
+async def resolve_unit_stage(order_id: str, stage_id: str) -> Optional[tuple]:
+    """(index, key field, key value) of a unit-counting stage, None if the order or stage does not exist.
+
+    Raises ValueError if the stage cannot take unit increments."""
+    order_data = await db.orders.find_one(
+        {"id": order_id},
+        {'_id': 0, 'workflow': 1, 'workflow_version': 1, 'stages.code': 1, 'stages.id': 1, 'stages.name': 1},
+    )
+    if order_data is None:
+        return None
+    stages = order_data.get('stages', [])
+    stage_index = next((i for i, stage in enumerate(stages) if stage_id in (stage.get('code'), stage.get('id'))), None)
+    if stage_index is None:
+        return None
+    workflow = workflow_registry.for_order(order_data)
+    if [stage_registry.code_for(stage) for stage in stages] != workflow.codes:
+        raise ValueError("Order stages do not match its workflow")
+    if workflow.kinds[stage_index] != StageKind.UNITS:
+        raise ValueError("Stage does not count units")
+    key = 'code' if stages[stage_index].get('code') else 'id'
+    return stage_index, key, stages[stage_index][key]
+
+async def increment_stage_units(order_id: str, stage_id: str, delta: int) -> Optional[dict]:
+    """Atomically add `delta` processed units to a stage, then recompute percentage and cascades once"""
+    target = await resolve_unit_stage(order_id, stage_id)
+    if target is None:
+        return None
+    stage_index, key, value = target
+    # Версия маршрута заказа неизменна, поэтому вид этапа проверен заранее; условие на ключ
+    # этапа гарантирует, что $inc попадёт именно в проверенный этап
+    order_data = await db.orders.find_one_and_update(
+        {"id": order_id, f"stages.{stage_index}.{key}": value},
+        {"$inc": {f"stages.{stage_index}.completed_units": delta}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if order_data is None:
+        return None
+    try:
+        return await recompute_after_increment(order_data, stage_index, delta)
+    except Exception as e:
+        # Детали уже учтены; ошибку не пробрасываем, чтобы инкремент не повторили дважды.
+        # Процент пересчитается при следующем изменении этапа
+        logger.error(f"Units added to stage {stage_id} of order {order_id}, but recalculation failed: {e}")
+        return order_data['stages'][stage_index]
+
+async def recompute_after_increment(order_data: dict, stage_index: int, delta: int) -> dict:
+    order_id = order_data['id']
+    stages = order_data['stages']
+    workflow = workflow_registry.for_order(order_data)
+    
+    units = stages[stage_index].get('completed_units') or 0
+    before = [dict(stage) for stage in stages]
+    before[stage_index]['completed_units'] = units - delta
+    if units < 0:
+        stages[stage_index]['completed_units'] = 0
+    set_ops, max_ops = workflow.apply(stages, stage_index, order_data.get('quantity', 1), to_bson_date(date.today()))
+    # Счётчик уже изменён через $inc, apply его не пишет
+    if units < 0:
+        max_ops[f'stages.{stage_index}.completed_units'] = 0
+    percentage = set_ops.pop(f'stages.{stage_index}.percentage', None)
+    if delta > 0 and percentage is not None:
+        max_ops[f'stages.{stage_index}.percentage'] = percentage
+    elif percentage is not None:
+        set_ops[f'stages.{stage_index}.percentage'] = percentage
+    # Переходы статуса и дат вычислены по снимку: пишутся, только если этап с тех пор не изменили,
+    # иначе параллельная правка этапа была бы откатана
+    transitions = {path: set_ops.pop(path) for path in list(set_ops) if path.rsplit('.', 1)[1] != 'percentage'}
+    update = {"$set": {**set_ops, **await revision_stamp()}}
+    if max_ops:
+        update["$max"] = max_ops
+    await db.orders.update_one({"id": order_id}, update)
+    if transitions:
+        guards = {}
+        for path in transitions:
+            _, index, field = path.split('.')
+            guards[path] = before[int(index)].get(field)
+        await db.orders.update_one(
+            {"id": order_id, **guards}, {"$set": {**transitions, **await revision_stamp()}}
+        )
+    await record_throughput(order_data, before, stages)
+    await invalidation_bus.publish(f"order:{order_id}", "orders")
+    return stages[stage_index]
+
+class StageCounterBuffer:
+    """Write-behind buffer coalescing bursts of unit increments into one write per stage"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._pending = {}  # (order_id, stage_id) -> delta
+        self._task = None
+        self.flushes = 0
+        self.coalesced = 0
+
+    def add(self, order_id: str, stage_id: str, delta: int) -> int:
+        key = (order_id, stage_id)
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = self._pending.get(key, 0) + delta
+        return self._pending[key]
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        for (order_id, stage_id), delta in pending.items():
+            if delta == 0:
+                continue
+            try:
+                if await increment_stage_units(order_id, stage_id, delta) is None:
+                    logger.warning(f"Dropped {delta} units for missing stage {stage_id} of order {order_id}")
+            except ValueError as e:
+                # Этап перестал принимать инкременты — повтор не поможет
+                logger.error(f"Dropped {delta} units for stage {stage_id} of order {order_id}: {e}")
+            except Exception as e:
+                # Сбой записи: возвращаем дельту в буфер, она уйдёт со следующим сбросом
+                logger.warning(f"Failed to flush {delta} units for stage {stage_id} of order {order_id}, will retry: {e}")
+                key = (order_id, stage_id)
+                self._pending[key] = self._pending.get(key, 0) + delta
+        if pending:
+            self.flushes += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # Буфер обязательно сбрасывается при остановке, чтобы не потерять отсканированные детали
+        for attempt in range(COUNTER_SHUTDOWN_RETRIES):
+            await self.flush()
+            if not self._pending:
+                return
+            await asyncio.sleep(2 ** attempt)
+        for (order_id, stage_id), delta in self._pending.items():
+            logger.error(f"Lost {delta} buffered units for stage {stage_id} of order {order_id} at shutdown")
+
+counter_buffer = StageCounterBuffer(COUNTER_FLUSH_INTERVAL)
+
+# Similar-order quoting
+QUOTE_INDEX_MAX_AGE = float(os.environ.get('QUOTE_INDEX_MAX_AGE', '60'))
+QUOTE_PROCESSING_TYPES = list(ProcessingType)
+QUOTE_FEATURES = len(QUOTE_PROCESSING_TYPES) + 4  # виды обработки, рынок, log(кол-во), log(мин/шт), log(материал/шт)
+QUOTE_PROJECTION = {
+    'id': 1, 'order_number': 1, 'client_name': 1, 'quantity': 1, 'market_type': 1, 'material_cost': 1,
+    'processing_time_per_unit': 1, 'processing_types': 1, 'minute_rate_domestic': 1, 'minute_rate_foreign': 1,
+    'stages': 1, 'created_at': 1, 'revision': 1, 'updated_at': 1,
+}
+
+def quote_features(quantity: int, market_type: str, material_cost: float,
+                   processing_time_per_unit: float, processing_types: List[str]) -> np.ndarray:
+    """Raw feature vector; scale-like values are log-transformed before standardization"""
+    vector = np.zeros(QUOTE_FEATURES, dtype=np.float64)
+    for i, processing_type in enumerate(QUOTE_PROCESSING_TYPES):
+        if processing_type.value in processing_types:
+            vector[i] = 1.0
+    offset = len(QUOTE_PROCESSING_TYPES)
+    quantity = max(quantity or 0, 0)
+    vector[offset] = 1.0 if market_type == MarketType.FOREIGN.value else 0.0
+    vector[offset + 1] = np.log1p(quantity)
+    vector[offset + 2] = np.log1p(max(processing_time_per_unit or 0, 0))
+    vector[offset + 3] = np.log1p(max(material_cost or 0, 0) / quantity if quantity else 0)
+    return vector
+
+def stage_by_code(order_data: dict, code: str) -> Optional[dict]:
+    for stage in order_data.get('stages', []):
+        if stage_registry.code_for(stage) == code:
+            return stage
+    return None
+
+def stored_datetime(value) -> datetime:
+    """A stored date as an aware datetime: BSON dates already are, ISO strings are left over from before the migration"""
+    if isinstance(value, datetime):
+        return value
+    parsed = datetime.fromisoformat(str(value))
+    # Даты этапов до миграции хранились без смещения, как календарные дни UTC
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def days_between(start, end) -> Optional[float]:
+    if not start or not end:
+        return None
+    return (stored_datetime(end) - stored_datetime(start)).total_seconds() / 86400
+
+def order_outcome(order_data: dict) -> dict:
+    """What actually happened with a historical order: lead times and cost (same formulas as Order)"""
+    manufacturing = stage_by_code(order_data, 'manufacturing') or {}
+    shipping = stage_by_code(order_data, SHIPPING_STAGE_CODE) or {}
+    quantity = order_data.get('quantity') or 0
+    material_cost = order_data.get('material_cost') or 0
+    minutes = order_data.get('processing_time_per_unit') or 0
+    if order_data.get('market_type') == MarketType.DOMESTIC.value:
+        rate = order_data.get('minute_rate_domestic', 25.0)
+    else:
+        rate = order_data.get('minute_rate_foreign', 0.42)
+    cost_per_unit = (material_cost / quantity if quantity > 0 else 0) + minutes * rate
+    return {
+        'order_id': order_data['id'],
+        'order_number': order_data.get('order_number'),
+        'client_name': order_data.get('client_name'),
+        'quantity': quantity,
+        'market_type': order_data.get('market_type'),
+        'processing_types': list(order_data.get('processing_types') or []),
+        'processing_time_per_unit': minutes,
+        'material_cost': material_cost,
+        'total_cost_per_unit': cost_per_unit,
+        'total_order_cost': cost_per_unit * quantity,
+        'manufacturing_days': days_between(manufacturing.get('start_date'), manufacturing.get('end_date')),
+        'lead_time_days': days_between(order_data.get('created_at'), shipping.get('end_date')),
+        'shipped': shipping.get('status') == StageStatus.COMPLETED.value,
+    }
+
+class QuoteIndex:
+    """In-memory NumPy matrix of order feature vectors, refreshed incrementally by revision"""
+
+    def __init__(self):
+        self.ids = []
+        self.position = {}
+        self.raw = np.empty((0, QUOTE_FEATURES), dtype=np.float64)
+        self.shipped = np.empty(0, dtype=bool)
+        self.outcomes = []
+        self.revision = 0
+        self.archive_loaded = False
+        self.refreshed_at = 0.0
+        self.dirty = True
+        self._scaled = None
+        self._mean = None
+        self._std = None
+        self._lock = asyncio.Lock()
+
+    def invalidate(self, key: str):
+        if key == 'orders' or key.startswith('order:'):
+            self.dirty = True
+
+    def _remove(self, order_id: str):
+        # Удаление перестановкой последней строки на место удаляемой — O(1)
+        i = self.position.pop(order_id, None)
+        if i is None:
+            return
+        last = len(self.ids) - 1
+        if i != last:
+            moved = self.ids[last]
+            self.ids[i] = moved
+            self.raw[i] = self.raw[last]
+            self.shipped[i] = self.shipped[last]
+            self.outcomes[i] = self.outcomes[last]
+            self.position[moved] = i
+        self.ids.pop()
+        self.outcomes.pop()
+        self.raw = self.raw[:last]
+        self.shipped = self.shipped[:last]
+
+    async def refresh(self):
+        if not self.dirty and time.monotonic() - self.refreshed_at < QUOTE_INDEX_MAX_AGE:
+            return
+        async with self._lock:
+            if not self.dirty and time.monotonic() - self.refreshed_at < QUOTE_INDEX_MAX_AGE:
+                return
+            self.dirty = False
+            # Курсор читается с первичного узла: вторичный может отставать дольше SYNC_SETTLE_SECONDS,
+            # и курсор прошёл бы изменения, которые туда ещё не дошли
+            changed = await db.orders.find({'revision': {'$gt': self.revision}}, QUOTE_PROJECTION).to_list(None)
+            removed = await db.order_tombstones.find({'revision': {'$gt': self.revision}}).to_list(None)
+            events = [(d.get('revision', 0), d.get('updated_at')) for d in changed + removed]
+            if not self.archive_loaded:
+                # Архив — основная история для расценки, при первой загрузке читаем и его
+                changed += await read_db('reports')[ARCHIVE_COLLECTION].find({}, QUOTE_PROJECTION).to_list(None)
+                self.archive_loaded = True
+            for tombstone in removed:
+                if tombstone.get('reason') != 'archived':
+                    self._remove(tombstone['id'])
+
+            new_rows, new_shipped = [], []
+            for order_data in changed:
+                try:
+                    outcome = order_outcome(order_data)
+                except Exception as e:
+                    logger.warning(f"Order {order_data.get('id')} skipped in quote index: {e}")
+                    continue
+                vector = quote_features(
+                    outcome['quantity'], outcome['market_type'], outcome['material_cost'],
+                    outcome['processing_time_per_unit'], outcome['processing_types']
+                )
+                i = self.position.get(outcome['order_id'])
+                if i is not None:
+                    self.raw[i] = vector
+                    self.shipped[i] = outcome['shipped']
+                    self.outcomes[i] = outcome
+                else:
+                    self.position[outcome['order_id']] = len(self.ids)
+                    self.ids.append(outcome['order_id'])
+                    self.outcomes.append(outcome)
+                    new_rows.append(vector)
+                    new_shipped.append(outcome['shipped'])
+            if new_rows:
+                self.raw = np.vstack([self.raw, np.array(new_rows)])
+                self.shipped = np.concatenate([self.shipped, np.array(new_shipped, dtype=bool)])
+            if changed or removed or self._scaled is None:
+                self._rescale()
+            # Неустоявшиеся изменения перечитываются при следующем обращении
+            self.revision = settled_revision(self.revision, events)
+            self.dirty = self.dirty or any(revision > self.revision for revision, _ in events)
+            self.refreshed_at = time.monotonic()
+
+    def _rescale(self):
+        if len(self.ids) == 0:
+            self._scaled = self.raw
+            self._mean = np.zeros(QUOTE_FEATURES)
+            self._std = np.ones(QUOTE_FEATURES)
+            return
+        self._mean = self.raw.mean(axis=0)
+        std = self.raw.std(axis=0)
+        self._std = np.where(std > 0, std, 1.0)
+        self._scaled = (self.raw - self._mean) / self._std
+
+    def nearest(self, vector: np.ndarray, k: int, shipped_only: bool = True) -> List[dict]:
+        if len(self.ids) == 0:
+            return []
+        distances = np.sqrt((((self._scaled - (vector - self._mean) / self._std)) ** 2).sum(axis=1))
+        if shipped_only:
+            distances = np.where(self.shipped, distances, np.inf)
+        k = min(k, len(distances))
+        # argpartition — O(n), затем сортируем только k лучших
+        candidates = np.argpartition(distances, k - 1)[:k]
+        candidates = candidates[np.argsort(distances[candidates])]
+        return [
+            {**self.outcomes[i], 'distance': round(float(distances[i]), 4)}
+            for i in candidates if np.isfinite(distances[i])
+        ]
+
+quote_index = QuoteIndex()
+invalidation_bus.subscribe(quote_index.invalidate)
+
+# Delivery date forecasting
+FORECAST_SIMULATIONS = int(os.environ.get('FORECAST_SIMULATIONS', '2000'))
+FORECAST_HISTORY_MAX_AGE = float(os.environ.get('FORECAST_HISTORY_MAX_AGE', '3600'))
+FORECAST_MIN_SAMPLES = 5
+FORECAST_BATCH_ORDERS = 500  # ограничивает матрицу симуляций заказы × FORECAST_SIMULATIONS
+FORECAST_DEFAULT_STAGE_DAYS = 1.0  # если по этапу нет истории вовсе
+
+async def load_stage_durations() -> dict:
+    """Observed durations (days) of completed stages, keyed by (stage code, processing type) and (stage code, None)"""
+    pipeline = [
+        {'$match': {'stages.status': StageStatus.COMPLETED.value}},
+        {'$project': {'processing_types': 1, 'stages': 1}},
+        {'$unwind': '$stages'},
+        {'$match': {
+            'stages.status': StageStatus.COMPLETED.value,
+            'stages.start_date': {'$type': 'date'},
+            'stages.end_date': {'$type': 'date'},
+        }},
+        {'$project': {
+            '_id': 0,
+            'code': '$stages.code',
+            'name': '$stages.name',
+            'processing_types': 1,
+            'days': {'$divide': [{'$subtract': ['$stages.end_date', '$stages.start_date']}, 86400000]},
+        }},
+    ]
+    samples = {}
+    database = read_db('reports')
+    for collection in (database.orders, database[ARCHIVE_COLLECTION]):
+        async for row in collection.aggregate(pipeline):
+            code = stage_registry.code_for(row)
+            if code is None or row['days'] < 0:
+                continue
+            # Этап, начатый и завершённый в один день, занимает день
+            days = max(row['days'], 1.0)
+            samples.setdefault((code, None), []).append(days)
+            for processing_type in row.get('processing_types') or []:
+                samples.setdefault((code, processing_type), []).append(days)
+    return {key: np.array(values) for key, values in samples.items()}
+
+class DeliveryForecaster:
+    """Monte Carlo P50/P90 ship dates for open orders from empirical stage durations"""
+
+    def __init__(self, simulations: int):
+        self.simulations = simulations
+        self.durations = {}
+        self.history_loaded_at = 0.0
+        self.orders = {}  # order_id -> open order document
+        self.forecasts = {}  # order_id -> forecast
+        self.revision = 0
+        self.dirty = True
+        self._lock = asyncio.Lock()
+        self._rng = np.random.default_rng()
+
+    def invalidate(self, key: str):
+        if key == 'orders' or key.startswith('order:'):
+            self.dirty = True
+
+    def _pool(self, code: str, processing_types: List[str]) -> np.ndarray:
+        pools = [self.durations[(code, t)] for t in processing_types if (code, t) in self.durations]
+        pool = np.concatenate(pools) if pools else np.empty(0)
+        if len(pool) < FORECAST_MIN_SAMPLES:
+            pool = self.durations.get((code, None), pool)
+        if len(pool) == 0:
+            pool = np.array([FORECAST_DEFAULT_STAGE_DAYS])
+        return pool
+
+    def _simulate(self, orders: List[dict]) -> dict:
+        """Sample remaining durations for the given orders in one batch per (stage, processing types) pool.
+
+        CPU-bound: runs in a worker thread, NumPy releases the GIL for the heavy parts."""
+        forecasts = {}
+        for start in range(0, len(orders), FORECAST_BATCH_ORDERS):
+            forecasts.update(self._simulate_batch(orders[start:start + FORECAST_BATCH_ORDERS]))
+        return forecasts
+
+    def _simulate_batch(self, orders: List[dict]) -> dict:
+        totals = np.zeros((len(orders), self.simulations))
+        demand = {}  # (code, types) -> ([row], [remaining fraction])
+        for row, order_data in enumerate(orders):
+            types = tuple(sorted(order_data.get('processing_types') or []))
+            for stage in order_data.get('stages', []):
+                if stage.get('status') == StageStatus.COMPLETED.value:
+                    continue
+                code = stage_registry.code_for(stage)
+                if code is None:
+                    continue
+                # Для частично выполненного этапа моделируем только оставшуюся долю
+                remaining = 1.0 - min(stage.get('percentage') or 0, 100) / 100
+                rows, fractions = demand.setdefault((code, types), ([], []))
+                rows.append(row)
+                fractions.append(remaining)
+
+        for (code, types), (rows, fractions) in demand.items():
+            pool = self._pool(code, list(types))
+            draws = pool[self._rng.integers(0, len(pool), size=(len(rows), self.simulations))]
+            np.add.at(totals, np.array(rows), draws * np.array(fractions)[:, None])
+
+        today = date.today()
+        p50, p90 = np.percentile(totals, [50, 90], axis=1) if len(orders) else ([], [])
+        forecasts = {}
+        for row, order_data in enumerate(orders):
+            forecasts[order_data['id']] = {
+                'order_id': order_data['id'],
+                'order_number': order_data.get('order_number'),
+                'client_name': order_data.get('client_name'),
+                'revision': order_data.get('revision', 0),
+                'remaining_days_p50': round(float(p50[row]), 1),
+                'remaining_days_p90': round(float(p90[row]), 1),
+                'ship_date_p50': date.fromordinal(today.toordinal() + int(np.ceil(p50[row]))),
+                'ship_date_p90': date.fromordinal(today.toordinal() + int(np.ceil(p90[row]))),
+            }
+        return forecasts
+
+    async def refresh(self):
+        history_stale = time.monotonic() - self.history_loaded_at > FORECAST_HISTORY_MAX_AGE
+        if not self.dirty and not history_stale:
+            return
+        async with self._lock:
+            history_stale = time.monotonic() - self.history_loaded_at > FORECAST_HISTORY_MAX_AGE
+            if not self.dirty and not history_stale:
+                return
+            self.dirty = False
+            # Как и в индексе расценок, курсор читается с первичного узла: отставание вторичного
+            # может превышать SYNC_SETTLE_SECONDS
+            changed = await db.orders.find(
+                {'revision': {'$gt': self.revision}},
+                {'id': 1, 'order_number': 1, 'client_name': 1, 'processing_types': 1, 'stages': 1,
+                 'revision': 1, 'updated_at': 1}
+            ).to_list(None)
+            removed = await db.order_tombstones.find({'revision': {'$gt': self.revision}}).to_list(None)
+            for tombstone in removed:
+                self.orders.pop(tombstone['id'], None)
+                self.forecasts.pop(tombstone['id'], None)
+
+            touched = []
+            for order_data in changed:
+                shipping = stage_by_code(order_data, SHIPPING_STAGE_CODE) or {}
+                if shipping.get('status') == StageStatus.COMPLETED.value:
+                    self.orders.pop(order_data['id'], None)
+                    self.forecasts.pop(order_data['id'], None)
+                else:
+                    self.orders[order_data['id']] = order_data
+                    touched.append(order_data['id'])
+
+            if history_stale:
+                # Новая история меняет распределения — пересчитываем все открытые заказы
+                self.durations = await load_stage_durations()
+                self.history_loaded_at = time.monotonic()
+                touched = list(self.orders)
+            if touched:
+                self.forecasts.update(await asyncio.to_thread(self._simulate, [self.orders[i] for i in touched]))
+            # Неустоявшиеся изменения перечитываются при следующем обращении
+            events = [(d.get('revision', 0), d.get('updated_at')) for d in changed + removed]
+            self.revision = settled_revision(self.revision, events)
+            self.dirty = self.dirty or any(revision > self.revision for revision, _ in events)
+
+deliveries = DeliveryForecaster(FORECAST_SIMULATIONS)
+invalidation_bus.subscribe(deliveries.invalidate)
+
+# Estimated vs. actual processing time
+REPORTS_COLLECTION = 'reports'
+ESTIMATE_ACCURACY_REPORT = 'estimate_accuracy'
+WORKDAY_MINUTES = float(os.environ.get('WORKDAY_MINUTES', '480'))
+
+def estimate_error_summary(frame: pd.DataFrame, key: str) -> List[dict]:
+    """Error distribution of per-unit estimates grouped by one dimension"""
+    grouped = frame.groupby(key)
+    summary = pd.DataFrame({
+        'orders': grouped['order_id'].nunique(),
+        'estimated_minutes_mean': grouped['estimated'].mean(),
+        'actual_minutes_mean': grouped['actual'].mean(),
+        'error_minutes_median': grouped['error'].median(),
+        'ratio_p10': grouped['ratio'].quantile(0.1),
+        'ratio_median': grouped['ratio'].median(),
+        'ratio_p90': grouped['ratio'].quantile(0.9),
+        'abs_pct_error_mean': grouped['abs_pct_error'].mean(),
+    }).reset_index().rename(columns={key: 'key'})
+    summary = summary.sort_values('orders', ascending=False)
+    return json.loads(summary.round(3).to_json(orient='records'))
+
+def compute_estimate_accuracy(rows: List[dict], workday_minutes: float) -> dict:
+    """Actual minutes per unit of the manufacturing stage vs. the estimate (runs in the process pool)"""
+    frame = pd.DataFrame(rows, columns=[
+        'order_id', 'client_name', 'responsible_person', 'processing_types',
+        'estimated', 'units', 'start_date', 'end_date',
+    ])
+    # Даты этапов хранятся с точностью до дня: этап, завершённый в день начала, занимает один рабочий день
+    days = (pd.to_datetime(frame['end_date']) - pd.to_datetime(frame['start_date'])).dt.days + 1
+    frame['actual'] = days * workday_minutes / frame['units']
+    frame = frame[(frame['units'] > 0) & (frame['estimated'] > 0) & (days > 0)].copy()
+    frame['error'] = frame['actual'] - frame['estimated']
+    frame['ratio'] = frame['actual'] / frame['estimated']
+    frame['abs_pct_error'] = np.abs(frame['error']) / frame['estimated'] * 100
+    frame['responsible_person'] = frame['responsible_person'].fillna('').replace('', 'не назначен')
+
+    by_type = frame.explode('processing_types').dropna(subset=['processing_types'])
+    return {
+        'orders': int(len(frame)),
+        'overall': {
+            'ratio_median': round(float(frame['ratio'].median()), 3) if len(frame) else None,
+            'abs_pct_error_mean': round(float(frame['abs_pct_error'].mean()), 3) if len(frame) else None,
+        },
+        'by_processing_type': estimate_error_summary(by_type, 'processing_types') if len(by_type) else [],
+        'by_client': estimate_error_summary(frame, 'client_name') if len(frame) else [],
+        'by_responsible_person': estimate_error_summary(frame, 'responsible_person') if len(frame) else [],
+    }
+
+@job_queue.handler('estimate_accuracy')
+async def estimate_accuracy_job(job_id: str, payload: dict) -> dict:
+    definition = stage_registry.get('manufacturing')
+    # Старые заказы без кода этапа ищутся по названию
+    identity = [{'code': 'manufacturing'}] + ([{'name': definition.name}] if definition else [])
+    pipeline = [
+        {'$match': {'stages': {'$elemMatch': {'status': StageStatus.COMPLETED.value, '$or': identity}}}},
+        {'$project': {
+            '_id': 0, 'id': 1, 'client_name': 1, 'processing_types': 1,
+            'processing_time_per_unit': 1, 'quantity': 1, 'stages': 1,
+        }},
+    ]
+    rows = []
+    database = read_db('reports')
+    for collection in (database.orders, database[ARCHIVE_COLLECTION]):
+        async for order_data in collection.aggregate(pipeline):
+            stage = stage_by_code(order_data, 'manufacturing') or {}
+            if not stage.get('start_date') or not stage.get('end_date'):
+                continue
+            rows.append({
+                'order_id': order_data['id'],
+                'client_name': order_data.get('client_name'),
+                'responsible_person': stage.get('responsible_person'),
+                'processing_types': list(order_data.get('processing_types') or []),
+                'estimated': order_data.get('processing_time_per_unit') or 0,
+                'units': stage.get('completed_units') or order_data.get('quantity') or 0,
+                # Календарные дни: в строках до миграции нет смещения, а pandas не смешивает их с aware датами
+                'start_date': stage_day(stage['start_date']),
+                'end_date': stage_day(stage['end_date']),
+            })
+
+    report = await job_queue.run_cpu(compute_estimate_accuracy, rows, WORKDAY_MINUTES)
+    await db[REPORTS_COLLECTION].replace_one(
+        {'_id': ESTIMATE_ACCURACY_REPORT},
+        {**report, 'workday_minutes': WORKDAY_MINUTES, 'generated_at': datetime.now(timezone.utc)},
+        upsert=True,
+    )
+    return {'orders': report['orders']}
+
+# Work in progress and bottlenecks
+WIP_PROJECTION = {
+    '_id': 0, 'id': 1, 'revision': 1, 'quantity': 1, 'workflow': 1, 'workflow_version': 1,
+    'stages.code': 1, 'stages.name': 1, 'stages.status': 1, 'stages.completed_units': 1,
+    'stages.start_date': 1, 'stages.end_date': 1,
+}
+
+def open_orders_filter() -> dict:
+    return {'stages': {'$not': {'$elemMatch': {'code': SHIPPING_STAGE_CODE, 'status': StageStatus.COMPLETED.value}}}}
+
+def orders_version_digest(versions: List[dict]) -> str:
+    """Digest of the (id, revision) pairs of a set of orders, independent of their order"""
+    digest = hashlib.md5()
+    for version in sorted(versions, key=lambda version: version['id']):
+        digest.update(f"{version['id']}:{version.get('revision', 0)};".encode())
+    return digest.hexdigest()
+
+def wip_matrices(compiled: CompiledWorkflow, orders: List[dict], today: date) -> tuple:
+    """Units done per stage and days since each stage started producing, one row per order"""
+    done = np.zeros((len(orders), len(compiled.codes)))
+    since = np.full((len(orders), len(compiled.codes)), np.nan)
+    for row, order_data in enumerate(orders):
+        quantity = order_data.get('quantity') or 0
+        for stage in order_data.get('stages', []):
+            i = compiled.position.get(stage_registry.code_for(stage))
+            if i is None:
+                continue
+            if compiled.kinds[i] == StageKind.UNITS:
+                done[row, i] = stage.get('completed_units') or 0
+            elif stage.get('status') == StageStatus.COMPLETED.value:
+                done[row, i] = quantity
+            # Единицы ждут следующий этап с момента, когда этот этап начал их выдавать
+            started = stage_day(stage.get('start_date') or stage.get('end_date'))
+            if started:
+                since[row, i] = (today - started).days
+    return done, since
+
+async def compute_wip_report() -> tuple:
+    """(report, versions digest of the open orders it was computed from)"""
+    orders_by_workflow = {}
+    versions = []
+    async for order_data in read_db('reports').orders.find(open_orders_filter(), WIP_PROJECTION):
+        key = (order_data.get('workflow') or DEFAULT_WORKFLOW_ID, order_data.get('workflow_version') or 1)
+        orders_by_workflow.setdefault(key, []).append(order_data)
+        versions.append(order_data)
+
+    today = date.today()
+    queues = {}  # stage code -> накопленные показатели очереди перед этапом
+    for (workflow_id, version), orders in orders_by_workflow.items():
+        try:
+            compiled = workflow_registry.get(workflow_id, version)
+        except ValueError:
+            logger.warning(f"WIP report skips {len(orders)} orders of unknown workflow {workflow_id} v{version}")
+            continue
+        if len(compiled.codes) < 2:
+            continue
+        done, since = wip_matrices(compiled, orders, today)
+        # Очередь перед этапом i: сделано на этапе i-1, но ещё не на этапе i
+        waiting = np.clip(done[:, :-1] - done[:, 1:], 0, None)
+        age = np.where(waiting > 0, since[:, :-1], np.nan)
+        for i, code in enumerate(compiled.codes[1:]):
+            column = waiting[:, i]
+            has_queue = column > 0
+            queue = queues.setdefault(code, {
+                'units': 0.0, 'orders': 0, 'age_weighted': 0.0, 'aged_units': 0.0, 'oldest_days': None,
+            })
+            queue['units'] += float(column.sum())
+            queue['orders'] += int(has_queue.sum())
+            ages = age[:, i]
+            known = has_queue & ~np.isnan(ages)
+            if known.any():
+                queue['age_weighted'] += float((ages[known] * column[known]).sum())
+                queue['aged_units'] += float(column[known].sum())
+                oldest = float(ages[known].max())
+                queue['oldest_days'] = max(queue['oldest_days'] or 0, oldest)
+
+    default_order = workflow_registry.get(DEFAULT_WORKFLOW_ID).position
+    stages = []
+    for code, queue in sorted(queues.items(), key=lambda item: default_order.get(item[0], len(default_order))):
+        definition = stage_registry.get(code)
+        stages.append({
+            'stage': code,
+            'name': definition.name if definition else code,
+            'units_waiting': int(queue['units']),
+            'orders_waiting': queue['orders'],
+            'avg_queue_age_days': round(queue['age_weighted'] / queue['aged_units'], 1) if queue['aged_units'] else None,
+            'oldest_queue_age_days': queue['oldest_days'],
+        })
+    # Узкое место — этап с наибольшей очередью, при равенстве — с более старой очередью
+    bottleneck = max(
+        (s for s in stages if s['units_waiting'] > 0),
+        key=lambda s: (s['units_waiting'], s['avg_queue_age_days'] or 0),
+        default=None,
+    )
+    return {
+        'open_orders': sum(len(orders) for orders in orders_by_workflow.values()),
+        'stages': stages,
+        'bottleneck': bottleneck['stage'] if bottleneck else None,
+        'generated_at': datetime.now(timezone.utc),
+    }, orders_version_digest(versions)
+
+class WipReportCache:
+    """WIP report recomputed only when some open order's revision (or the day) changes"""
+
+    def __init__(self):
+        self.key = None
+        self.report = None
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> dict:
+        # Ключ строится по версиям самих заказов, а не по счётчику ревизий: ревизия выделяется до записи
+        versions = read_db('reports').orders.find(open_orders_filter(), {'_id': 0, 'id': 1, 'revision': 1})
+        key = (orders_version_digest(await versions.to_list(None)), date.today())
+        if key == self.key:
+            return self.report
+        async with self._lock:
+            if key != self.key:
+                # Отчёт запоминается под версиями заказов, из которых он посчитан: чтение версий
+                # могло попасть на другой вторичный узел, и тогда следующий запрос пересчитает отчёт
+                self.report, digest = await compute_wip_report()
+                self.key = (digest, key[1])
+        return self.report
+
+wip_reports = WipReportCache()
+
+# Overdue stage detection
+OVERDUE_CHECK_INTERVAL = float(os.environ.get('OVERDUE_CHECK_INTERVAL', '300'))
+OVERDUE_BATCH_SIZE = int(os.environ.get('OVERDUE_BATCH_SIZE', '500'))
+OPEN_STAGE_STATUSES = [StageStatus.PENDING.value, StageStatus.IN_PROGRESS.value]
+
+def overdue_stage_filter(today: date) -> dict:
+    return {'status': {'$in': OPEN_STAGE_STATUSES}, 'end_date': {'$lt': to_bson_date(today)}}
+
+async def ensure_overdue_indexes():
+    # Статус первым: границы индекса охватывают только незавершённые этапы с прошедшим сроком
+    await db.orders.create_index([('stages.status', 1), ('stages.end_date', 1)])
+    await db.notifications.create_index('key', unique=True)
+    await db.notifications.create_index([('created_at', -1)])
+
+async def mark_overdue_stages(today: Optional[date] = None) -> int:
+    """Switch open stages past their end date to delayed; returns the number of orders touched.
+
+    Stages already marked delayed no longer match, so every pass only sees new overdue stages."""
+    today = today or date.today()
+    stage_filter = overdue_stage_filter(today)
+    touched = 0
+    while True:
+        batch = await db.orders.find(
+            {'stages': {'$elemMatch': stage_filter}},
+            {'_id': 0, 'id': 1, 'order_number': 1, 'client_name': 1, 'stages': 1},
+        ).limit(OVERDUE_BATCH_SIZE).to_list(OVERDUE_BATCH_SIZE)
+        if not batch:
+            return touched
+
+        last_revision = await next_revision(len(batch))
+        now = datetime.now(timezone.utc)
+        requests = []
+        notifications = []
+        for i, order_data in enumerate(batch):
+            requests.append(UpdateOne(
+                {'id': order_data['id'], 'stages': {'$elemMatch': stage_filter}},
+                {'$set': {
+                    'stages.$[overdue].status': StageStatus.DELAYED.value,
+                    'revision': last_revision - len(batch) + 1 + i,
+                    'updated_at': now,
+                }},
+                array_filters=[{f'overdue.{field}': condition for field, condition in stage_filter.items()}],
+            ))
+            for stage in order_data['stages']:
+                if stage.get('status') not in OPEN_STAGE_STATUSES:
+                    continue
+                # Фильтр массива сравнивает только даты BSON: строковые даты до миграции не меняются,
+                # и уведомлять о них нечего
+                if not isinstance(stage.get('end_date'), datetime) or stage['end_date'].date() >= today:
+                    continue
+                code = stage_registry.code_for(stage) or stage.get('name')
+                # Ключ уникален, поэтому параллельные воркеры не дублируют уведомления
+                notifications.append(UpdateOne(
+                    {'key': f"stage_delayed:{order_data['id']}:{code}:{stage['end_date'].date().isoformat()}"},
+                    {'$setOnInsert': {
+                        'id': str(uuid.uuid4()),
+                        'type': 'stage_delayed',
+                        'order_id': order_data['id'],
+                        'order_number': order_data.get('order_number'),
+                        'client_name': order_data.get('client_name'),
+                        'stage': code,
+                        'end_date': stage['end_date'],
+                        'created_at': now,
+                    }},
+                    upsert=True,
+                ))
+        result = await db.orders.bulk_write(requests, ordered=False)
+        if result.modified_count == 0:
+            # Всё уже обработано другим воркером
+            return touched
+        if notifications:
+            await db.notifications.bulk_write(notifications, ordered=False)
+        ids = [order_data['id'] for order_data in batch]
+        await invalidation_bus.publish("orders", *[f"order:{order_id}" for order_id in ids])
+        touched += result.modified_count
+        logger.info(f"Marked overdue stages as delayed in {result.modified_count} orders")
+
+class OverdueDetector:
+    """Periodic background pass over the overdue-stage index"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+        self.last_run = None
+        self.last_touched = 0
+
+    async def _run(self):
+        while True:
+            try:
+                self.last_touched = await mark_overdue_stages()
+                self.last_run = datetime.now(timezone.utc)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Overdue stage check failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+overdue_detector = OverdueDetector(OVERDUE_CHECK_INTERVAL)
+
+# Event loop stall watchdog
+LOOP_WATCHDOG_ENABLED = os.environ.get('LOOP_WATCHDOG_ENABLED', 'false').lower() == 'true'
+LOOP_WATCHDOG_INTERVAL = float(os.environ.get('LOOP_WATCHDOG_INTERVAL', '0.1'))
+LOOP_STALL_THRESHOLD = float(os.environ.get('LOOP_STALL_THRESHOLD', '0.5'))
+
+class LoopWatchdog:
+    """Measures event loop lag and captures the loop thread's stack while it is blocked.
+
+    A coroutine ticks every `interval` and records how late it woke up. A separate thread
+    watches the tick heartbeat: once it is older than `threshold`, the loop is stuck in one
+    callback and the thread samples that callback's stack."""
+
+    def __init__(self, interval: float, threshold: float, samples: int = 3000):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = collections.deque(maxlen=samples)  # секунды
+        self.stalls = collections.deque(maxlen=20)
+        self.stall_count = 0
+        self.max_lag = 0.0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    async def _tick(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._heartbeat = now
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                logger.warning(f"Event loop was blocked for {lag * 1000:.0f}ms")
+
+    def _watch(self):
+        reported = None
+        while not self._stopped.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            # Один снимок стека на каждую остановку цикла
+            if blocked < self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            self.stall_count += 1
+            self.stalls.append({
+                'at': datetime.now(timezone.utc),
+                'blocked_ms': round(blocked * 1000),
+                'stack': stack,
+            })
+            logger.warning(f"Event loop blocked for over {blocked * 1000:.0f}ms in:\n{stack}")
+
+    async def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._tick())
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> dict:
+        lags = np.array(self.lags) * 1000
+        return {
+            'interval_ms': self.interval * 1000,
+            'threshold_ms': self.threshold * 1000,
+            'samples': len(lags),
+            'lag_p50_ms': round(float(np.percentile(lags, 50)), 2) if len(lags) else None,
+            'lag_p99_ms': round(float(np.percentile(lags, 99)), 2) if len(lags) else None,
+            'lag_max_ms': round(self.max_lag * 1000, 2),
+            'stalls': self.stall_count,
+        }
+
+loop_watchdog = LoopWatchdog(LOOP_WATCHDOG_INTERVAL, LOOP_STALL_THRESHOLD)
+
+# Admission control and load shedding
+class AdmissionClass:
+    """Concurrency limit with a bounded wait queue for one priority class of routes"""
+
+    def __init__(self, name: str, priority: int, max_concurrent: int, max_queue: int,
+                 queue_timeout: float, global_share: float):
+        self.name = name
+        self.priority = priority
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # Доля общей ёмкости, при превышении которой запросы этого класса сбрасываются
+        self.global_share = global_share
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.inflight = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.shed = 0
+
+    def stats(self) -> dict:
+        return {
+            'priority': self.priority,
+            'max_concurrent': self.max_concurrent,
+            'max_queue': self.max_queue,
+            'queue_timeout': self.queue_timeout,
+            'global_share': self.global_share,
+            'inflight': self.inflight,
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'admitted': self.admitted,
+            'rejected_queue_full': self.rejected_queue_full,
+            'rejected_timeout': self.rejected_timeout,
+            'shed': self.shed,
+        }
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+DEFAULT_ADMISSION_CLASSES = {
+    # Сканеры цеха: обновление этапов никогда не должно ждать дашборды
+    'critical': {'priority': 0, 'max_concurrent': 64, 'max_queue': 256, 'queue_timeout': 5.0, 'global_share': 1.0},
+    'write': {'priority': 1, 'max_concurrent': 32, 'max_queue': 64, 'queue_timeout': 2.0, 'global_share': 0.9},
+    'read': {'priority': 2, 'max_concurrent': 32, 'max_queue': 64, 'queue_timeout': 1.0, 'global_share': 0.8},
+    'bulk': {'priority': 3, 'max_concurrent': 8, 'max_queue': 16, 'queue_timeout': 0.5, 'global_share': 0.6},
+}
+
+# (HTTP-метод или '*', регулярное выражение пути, класс); первое совпадение выигрывает
+ADMISSION_RULES = [
+    ('*', re.compile(r'^/api/health(/|$)'), None),
+    ('PUT', re.compile(r'^/api/orders/[^/]+/stages/[^/]+$'), 'critical'),
+    ('POST', re.compile(r'^/api/orders/[^/]+/stages/[^/]+/increment$'), 'critical'),
+    ('GET', re.compile(r'^/api/orders/?$'), 'bulk'),
+    ('GET', re.compile(r'^/api/reports/'), 'bulk'),
+    ('GET', re.compile(r'^/api/forecasts$'), 'bulk'),
+    ('GET', re.compile(r'^/api/'), 'read'),
+    ('*', re.compile(r'^/api/'), 'write'),
+]
+
+class AdmissionController:
+    """Admits requests per priority class and sheds low-priority load when the worker is saturated"""
+
+    def __init__(self, max_inflight: int, classes: dict, retry_after: int = 1):
+        self.max_inflight = max_inflight
+        self.retry_after = retry_after
+        self.inflight = 0
+        self.classes = {
+            name: AdmissionClass(name=name, **config) for name, config in classes.items()
+        }
+
+    def classify(self, method: str, path: str) -> Optional[AdmissionClass]:
+        for rule_method, pattern, class_name in ADMISSION_RULES:
+            if rule_method in ('*', method) and pattern.match(path):
+                return self.classes.get(class_name) if class_name else None
+        return None
+
+    async def acquire(self, admission_class: AdmissionClass):
+        if self.inflight >= self.max_inflight * admission_class.global_share:
+            admission_class.shed += 1
+            raise AdmissionRejected(503, "Server is busy, try again later", self.retry_after)
+        if admission_class.semaphore.locked():
+            if admission_class.waiting >= admission_class.max_queue:
+                admission_class.rejected_queue_full += 1
+                raise AdmissionRejected(429, "Too many concurrent requests", self.retry_after)
+            admission_class.waiting += 1
+            admission_class.max_waiting = max(admission_class.max_waiting, admission_class.waiting)
+            try:
+                await asyncio.wait_for(admission_class.semaphore.acquire(), admission_class.queue_timeout)
+            except asyncio.TimeoutError:
+                admission_class.rejected_timeout += 1
+                raise AdmissionRejected(503, "Server is busy, try again later", self.retry_after)
+            finally:
+                admission_class.waiting -= 1
+        else:
+            await admission_class.semaphore.acquire()
+        admission_class.inflight += 1
+        admission_class.admitted += 1
+        self.inflight += 1
+
+    def release(self, admission_class: AdmissionClass):
+        admission_class.inflight -= 1
+        self.inflight -= 1
+        admission_class.semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            'max_inflight': self.max_inflight,
+            'inflight': self.inflight,
+            'classes': {name: c.stats() for name, c in self.classes.items()},
+        }
+
+def load_admission_classes() -> dict:
+    """Default class limits overridden by the ADMISSION_LIMITS JSON object"""
+    classes = {name: dict(config) for name, config in DEFAULT_ADMISSION_CLASSES.items()}
+    overrides = json.loads(os.environ.get('ADMISSION_LIMITS', '{}'))
+    for name, config in overrides.items():
+        if name not in classes:
+            raise ValueError(f"Unknown admission class: {name}")
+        classes[name].update(config)
+    return classes
+
+ADMISSION_ENABLED = os.environ.get('ADMISSION_CONTROL', 'true').lower() in ('1', 'true', 'yes')
+admission = AdmissionController(
+    max_inflight=int(os.environ.get('ADMISSION_MAX_INFLIGHT', '96')),
+    classes=load_admission_classes(),
+    retry_after=int(os.environ.get('ADMISSION_RETRY_AFTER', '1')),
+)
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    admission_class = admission.classify(request.method, request.url.path) if ADMISSION_ENABLED else None
+    if admission_class is None:
+        return await call_next(request)
+    try:
+        await admission.acquire(admission_class)
+    except AdmissionRejected as e:
+        return JSONResponse(
+            status_code=e.status_code,
+            content={"detail": e.detail},
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    try:
+        return await call_next(request)
+    finally:
+        admission.release(admission_class)
+
+# Routes
+@api_router.post("/auth/register", response_model=User)
+async def register_user(user_data: UserCreate):
+    # Check if user exists
+    existing_user = await db.users.find_one({"username": user_data.username})
+    if existing_user:
+        raise HTTPException(status_code=400, detail="Username already exists")
+    
+    # Create user
+    hashed_password = hash_password(user_data.password)
+    user = User(username=user_data.username, role=user_data.role)
+    user_dict = user.dict()
+    user_dict['password'] = hashed_password
+    
+    await db.users.insert_one(user_dict)
+    return user
+
+@api_router.post("/auth/login", response_model=LoginResponse)
+async def login_user(login_data: UserLogin):
+    user_data = await db.users.find_one({"username": login_data.username})
+    if not user_data:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    hashed_password = hash_password(login_data.password)
+    if user_data['password'] != hashed_password:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+    
+    user = User(**user_data)
+    token = create_access_token(user.id, user.username, user.role)
+    
+    return LoginResponse(access_token=token, user=user)
+
+@api_router.get("/auth/me", response_model=User)
+async def get_current_user_info(current_user: User = Depends(get_current_user)):
+    return current_user
+
+@api_router.get("/stages/definitions", response_model=List[StageDefinition])
+async def get_stage_definitions(current_user: User = Depends(get_current_user)):
+    return stage_registry.definitions
+
+@api_router.put("/stages/definitions/{code}", response_model=StageDefinition)
+async def put_stage_definition(
+    code: str,
+    definition: StageDefinition,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can edit stage definitions")
+    if definition.code != code:
+        raise HTTPException(status_code=400, detail="Stage code does not match the URL")
+    existing = stage_registry.get(code)
+    if existing and existing.has_units != definition.has_units:
+        # Вид этапа определяет, как хранятся данные уже созданных заказов
+        raise HTTPException(status_code=400, detail="has_units of an existing stage cannot be changed")
+    
+    await db.stage_definitions.replace_one({'code': code}, definition.dict(), upsert=True)
+    await stage_registry.load()
+    await invalidation_bus.publish('stage_definitions')
+    return definition
+
+@api_router.get("/workflows", response_model=List[Workflow])
+async def get_workflows(current_user: User = Depends(get_current_user)):
+    return list(workflow_registry.workflows.values())
+
+@api_router.put("/workflows/{workflow_id}", response_model=Workflow)
+async def put_workflow(
+    workflow_id: str,
+    workflow: Workflow,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can edit workflows")
+    if workflow.id != workflow_id:
+        raise HTTPException(status_code=400, detail="Workflow id does not match the URL")
+    # Компиляция проверяет, что этапы известны и зависимости не образуют цикл
+    try:
+        CompiledWorkflow(workflow, stage_registry)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Существующие версии не меняются: заказы в работе продолжают идти по своей версии
+    latest = await db.workflows.find_one({'id': workflow_id}, sort=[('version', -1)])
+    workflow.version = latest['version'] + 1 if latest else 1
+    try:
+        await db.workflows.insert_one(workflow.dict())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Workflow was modified concurrently, retry")
+    await workflow_registry.load()
+    await invalidation_bus.publish('workflows')
+    return workflow
+
+@api_router.post("/orders", response_model=Order)
+async def create_order(
+    order_data: OrderCreate,
+    current_user: User = Depends(get_current_user)
+):
+    order_number = order_data.order_number
+    if not order_number:
+        order_number, = await order_numbers.allocate(order_data.market_type)
+    elif await archived_order_numbers([order_number]):
+        raise HTTPException(status_code=409, detail=f"Order number {order_number} already exists")
+    order, order_dict = build_order(order_data, order_number, current_user, await revision_stamp())
+    
+    try:
+        await db.orders.insert_one(order_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail=f"Order number {order_number} already exists")
+    await index_order_for_search(order_dict)
+    await invalidation_bus.publish("orders")
+    return order
+
+def build_order(order_data: OrderCreate, order_number: str, user: User, stamp: dict) -> tuple:
+    """(Order, storage dict) for a new order"""
+    order_fields = order_data.dict()
+    order_fields['order_number'] = order_number
+    order_fields['workflow'] = order_data.workflow or workflow_registry.select(order_data.processing_types)
+    try:
+        workflow = workflow_registry.get(order_fields['workflow'])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    order_fields['workflow_version'] = workflow.workflow.version
+    stages = create_default_stages(order_fields['workflow'], workflow.workflow.version)
+    
+    order = Order(
+        **order_fields,
+        created_by=user.id,
+        stages=stages,
+        **stamp
+    )
+    order_dict = prepare_for_mongo(order.dict())
+    order_dict['stages'] = [compact_stage(stage) for stage in order_dict['stages']]
+    return order, order_dict
+
+@api_router.post("/orders/import", response_model=List[Order])
+async def import_orders(
+    orders_data: List[OrderCreate],
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can import orders")
+    if not orders_data:
+        raise HTTPException(status_code=400, detail="No orders to import")
+    archived = await archived_order_numbers([o.order_number for o in orders_data if o.order_number])
+    if archived:
+        raise HTTPException(
+            status_code=409, detail=f"Order numbers already used by archived orders: {', '.join(archived)}"
+        )
+    
+    # Номера резервируются одним блоком на рынок, а не запросом к счётчику на каждый заказ
+    numbers = {}
+    for market_type in MarketType:
+        missing = sum(1 for o in orders_data if not o.order_number and o.market_type == market_type)
+        if missing:
+            numbers[market_type] = iter(await order_numbers.allocate(market_type, missing))
+    last_revision = await next_revision(len(orders_data))
+    now = datetime.now(timezone.utc)
+    
+    orders, order_dicts = [], []
+    for i, order_data in enumerate(orders_data):
+        order_number = order_data.order_number or next(numbers[order_data.market_type])
+        stamp = {'revision': last_revision - len(orders_data) + 1 + i, 'updated_at': now}
+        order, order_dict = build_order(order_data, order_number, current_user, stamp)
+        orders.append(order)
+        order_dicts.append(order_dict)
+    
+    try:
+        await db.orders.insert_many(order_dicts, ordered=True)
+    except BulkWriteError as e:
+        inserted = e.details.get('nInserted', 0)
+        for order_dict in order_dicts[:inserted]:
+            await index_order_for_search(order_dict)
+        await invalidation_bus.publish("orders")
+        raise HTTPException(status_code=409, detail=f"Import stopped after {inserted} orders: duplicate order number")
+    for order_dict in order_dicts:
+        await index_order_for_search(order_dict)
+    await invalidation_bus.publish("orders")
+    return orders
+
+@api_router.get("/orders", response_model=List[Order])
+async def get_orders(
+    request: Request,
+    include_archived: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    database = read_db('orders_list')
+    
+    async def find_orders(projection=None) -> List[dict]:
+        orders = await database.orders.find({}, projection).sort('_id', 1).to_list(1000)
+        if include_archived and len(orders) < 1000:
+            orders += await database[ARCHIVE_COLLECTION].find({}, projection).sort('_id', 1).to_list(1000 - len(orders))
+        return orders
+    
+    async def scan_versions() -> str:
+        return orders_collection_etag(current_user.role, await find_orders(ORDER_VERSION_PROJECTION), include_archived)
+    
+    # Сначала читаются только версии заказов: при совпадении ETag документы целиком не загружаются.
+    # Проверка версий тоже идёт через hot_reads, иначе толпа одинаковых запросов сканировала бы их каждый сам
+    etag = await hot_reads.get(('orders/etag', current_user.role.value, include_archived), scan_versions)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    async def load_orders() -> tuple:
+        orders = await find_orders()
+        result = []
+        for order_data in orders:
+            # Filter sensitive data for employees
+            result.append(filter_order_for_role(Order(**order_data), current_user))
+        # ETag ответа строится по загруженным документам: чтение версий могло попасть на другой вторичный узел
+        return render_json(result), orders_collection_etag(current_user.role, orders, include_archived)
+    
+    # Одновременные одинаковые запросы (например, 40 экранов после пересменки) разделяют одно чтение.
+    # ETag входит в ключ: он уже включает роль, параметры и версии заказов
+    body, body_etag = await hot_reads.get(('orders', etag), load_orders)
+    return cached_json_response(body, body_etag)
+
+class OrderSearchResponse(BaseModel):
+    query: str
+    mode: str
+    total: int
+    page: int
+    page_size: int
+    results: List[Order]
+
+@api_router.get("/orders/search", response_model=OrderSearchResponse)
+async def search_orders(
+    request: Request,
+    q: str,
+    page: int = 1,
+    page_size: int = 20,
+    include_archived: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    query = q.strip()
+    if not query:
+        raise HTTPException(status_code=400, detail="Search query is empty")
+    page = max(1, page)
+    page_size = min(max(1, page_size), 100)
+    
+    database = read_db('search')
+    mode, total, order_ids = await search_order_ids(query, (page - 1) * page_size, page_size, include_archived)
+    
+    async def find_orders(projection=None) -> dict:
+        orders_by_id = {}
+        if order_ids:
+            async for order_data in database.orders.find({"id": {"$in": order_ids}}, projection):
+                orders_by_id[order_data['id']] = order_data
+            if include_archived and len(orders_by_id) < len(order_ids):
+                async for order_data in database[ARCHIVE_COLLECTION].find({"id": {"$in": order_ids}}, projection):
+                    orders_by_id[order_data['id']] = order_data
+        return orders_by_id
+    
+    versions = await find_orders(ORDER_VERSION_PROJECTION)
+    etag = orders_collection_etag(
+        current_user.role, [versions[order_id] for order_id in order_ids if order_id in versions],
+        query, page, page_size, include_archived, mode, total,
+    )
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    async def run_search() -> tuple:
+        orders_by_id = await find_orders()
+        
+        found = [orders_by_id[order_id] for order_id in order_ids if order_id in orders_by_id]
+        results = [filter_order_for_role(Order(**order_data), current_user) for order_data in found]
+        
+        body = render_json(OrderSearchResponse(
+            query=query, mode=mode, total=total, page=page, page_size=page_size, results=results
+        ))
+        # Как и в списке заказов, ETag ответа строится по загруженным документам, а не по отдельному чтению версий
+        return body, orders_collection_etag(
+            current_user.role, found, query, page, page_size, include_archived, mode, total
+        )
+    
+    body, body_etag = await hot_reads.get(('orders/search', etag), run_search)
+    return cached_json_response(body, body_etag)
+
+@api_router.post("/orders/search/reindex")
+async def reindex_orders_search(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can rebuild the search index")
+    
+    job_id = await job_queue.enqueue('reindex_search', {})
+    return {"message": "Search index rebuild started", "job_id": job_id}
+
+class OrderChanges(BaseModel):
+    since: int
+    revision: int  # значение since для следующего запроса
+    orders: List[Order]
+    deleted: List[str]
+    has_more: bool
+
+@api_router.get("/orders/changes", response_model=OrderChanges)
+async def get_order_changes(
+    since: int = 0,
+    limit: int = 500,
+    current_user: User = Depends(get_current_user)
+):
+    limit = min(max(1, limit), 1000)
+    if since > 0 and since < await tombstone_retention.horizon():
+        # Удаления старше курсора уже забыты: клиент должен заново загрузить всё с since=0
+        raise HTTPException(
+            status_code=410,
+            detail="Sync cursor is older than the deletion history; resync with since=0",
+        )
+    orders = await db.orders.find({"revision": {"$gt": since}}).sort("revision", 1).to_list(limit + 1)
+    tombstones = []
+    if since > 0:
+        tombstones = await db.order_tombstones.find({"revision": {"$gt": since}}).sort("revision", 1).to_list(limit + 1)
+    
+    events = sorted(
+        [(o['revision'], o.get('updated_at'), 'order', o) for o in orders] +
+        [(t['revision'], t.get('updated_at'), 'deleted', t) for t in tombstones],
+        key=lambda event: event[0]
+    )
+    has_more = len(events) > limit
+    events = events[:limit]
+    
+    # Более свежие изменения будут повторно отданы в следующем ответе
+    next_revision_cursor = settled_revision(since, [(revision, updated_at) for revision, updated_at, _, _ in events])
+    if has_more and next_revision_cursor == since and events:
+        next_revision_cursor = events[0][0]
+    
+    changed_orders = [
+        filter_order_for_role(Order(**data), current_user)
+        for _, _, kind, data in events if kind == 'order'
+    ]
+    deleted = [data['id'] for _, _, kind, data in events if kind == 'deleted']
+    return OrderChanges(
+        since=since,
+        revision=next_revision_cursor,
+        orders=changed_orders,
+        deleted=deleted,
+        has_more=has_more
+    )
+
+class OrderRestoreRequest(BaseModel):
+    order_ids: List[str]
+
+@api_router.post("/orders/archive")
+async def archive_orders(
+    older_than_days: int = ARCHIVE_AFTER_DAYS,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can archive orders")
+    if older_than_days < 0:
+        raise HTTPException(status_code=400, detail="older_than_days must not be negative")
+    
+    job_id = await job_queue.enqueue('archive_orders', {'older_than_days': older_than_days})
+    return {"message": "Archiving started", "job_id": job_id}
+
+@api_router.post("/orders/restore")
+async def restore_orders(
+    restore_request: OrderRestoreRequest,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can restore orders")
+    if not restore_request.order_ids:
+        raise HTTPException(status_code=400, detail="No orders to restore")
+    
+    restored, conflicts = await move_orders(
+        db[ARCHIVE_COLLECTION], db.orders, {"id": {"$in": restore_request.order_ids}}, archived=False
+    )
+    if conflicts:
+        return {
+            "message": "Some orders were not restored: their order numbers are used by active orders",
+            "restored": restored,
+            "conflicts": conflicts,
+        }
+    return {"message": "Orders restored", "restored": restored}
+
+@api_router.get("/orders/{order_id}", response_model=Order)
+async def get_order(
+    order_id: str,
+    request: Request,
+    response: Response,
+    include_archived: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    database = read_db('order_detail')
+    order_data = await database.orders.find_one({"id": order_id})
+    if not order_data and include_archived:
+        order_data = await database[ARCHIVE_COLLECTION].find_one({"id": order_id})
+    if not order_data:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    # Если клиент уже видел эту ревизию, пропускаем разбор документа и сериализацию
+    etag = order_etag(order_data, current_user.role)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    set_etag_headers(response, etag)
+    
+    # Filter sensitive data for employees
+    return filter_order_for_role(Order(**order_data), current_user)
+
+@api_router.put("/orders/{order_id}", response_model=Order)
+async def update_order(
+    order_id: str,
+    order_update: OrderUpdate,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can update orders")
+    
+    update_data = {k: v for k, v in order_update.dict().items() if v is not None}
+    if not update_data:
+        raise HTTPException(status_code=400, detail="No update data provided")
+    
+    update_data.update(await revision_stamp())
+    await db.orders.update_one({"id": order_id}, {"$set": update_data})
+    
+    order_data = await db.orders.find_one({"id": order_id})
+    if not order_data:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    await index_order_for_search(order_data)
+    await invalidation_bus.publish(f"order:{order_id}", "orders")
+    return Order(**order_data)
+
+@api_router.put("/orders/{order_id}/stages/{stage_id}")
+async def update_stage(
+    order_id: str,
+    stage_id: str,
+    stage_update: StageUpdate,
+    current_user: User = Depends(get_current_user)
+):
+    order_data = await db.orders.find_one({"id": order_id})
+    if not order_data:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    stages = order_data.get('stages', [])
+    stage_index = next(
+        # Компактные этапы адресуются кодом, старые документы — UUID этапа
+        (i for i, stage in enumerate(stages) if stage.get('id') == stage_id or stage.get('code') == stage_id),
+        None
+    )
+    if stage_index is None:
+        raise HTTPException(status_code=404, detail="Stage not found")
+    
+    try:
+        workflow = workflow_registry.for_order(order_data)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if [stage_registry.code_for(stage) for stage in stages] != workflow.codes:
+        raise HTTPException(status_code=409, detail="Order stages do not match its workflow")
+    
+    before = [dict(stage) for stage in stages]
+    
+    # Обновляем поля этапа
+    stage = stages[stage_index]
+    sent = {key: value for key, value in stage_update.dict().items() if value is not None}
+    for key, value in sent.items():
+        stage[key] = to_bson_date(value) if isinstance(value, date) else value
+    
+    # Пересчёт процента и каскад на предыдущие этапы одним обновлением только затронутых полей.
+    # Из снимка этапа пишутся только присланные поля: иначе параллельный $inc откатился бы
+    set_ops, max_ops = workflow.apply(stages, stage_index, order_data.get('quantity', 1), to_bson_date(date.today()))
+    set_ops.update({f'stages.{stage_index}.{key}': stage[key] for key in sent})
+    update = {"$set": {**set_ops, **await revision_stamp()}}
+    if max_ops:
+        update["$max"] = max_ops
+    # Условие на код этапа защищает позиционные пути от чужого документа
+    stage_key = 'code' if stage.get('code') else 'id'
+    result = await db.orders.update_one(
+        {"id": order_id, f"stages.{stage_index}.{stage_key}": stage[stage_key]}, update
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=409, detail="Order was modified concurrently, retry")
+    await record_throughput(order_data, before, stages)
+    if stage_update.notes is not None:
+        await index_order_for_search(order_data)
+    await invalidation_bus.publish(f"order:{order_id}", "orders")
+    return {"message": "Stage updated successfully"}
+
+@api_router.post("/orders/{order_id}/stages/{stage_id}/increment")
+async def increment_stage(
+    order_id: str,
+    stage_id: str,
+    increment: StageIncrement,
+    current_user: User = Depends(get_current_user)
+):
+    if increment.delta == 0:
+        raise HTTPException(status_code=400, detail="Increment must not be zero")
+    
+    if counter_buffer.interval > 0:
+        # Проверяем заказ и этап сразу, иначе ошибка обнаружится только при сбросе буфера
+        try:
+            target = await resolve_unit_stage(order_id, stage_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if target is None:
+            raise HTTPException(status_code=404, detail="Order or stage not found")
+        pending = counter_buffer.add(order_id, stage_id, increment.delta)
+        return JSONResponse(status_code=202, content={"message": "Increment buffered", "pending": pending})
+    
+    try:
+        stage = await increment_stage_units(order_id, stage_id, increment.delta)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if stage is None:
+        raise HTTPException(status_code=404, detail="Order or stage not found")
+    return {
+        "message": "Stage updated successfully",
+        "completed_units": stage.get('completed_units'),
+        "percentage": stage.get('percentage'),
+    }
+
+@api_router.post("/orders/{order_id}/files")
+async def upload_file(
+    order_id: str,
+    file: UploadFile = File(...),
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can upload files")
+    
+    # Check if order exists
+    order_data = await db.orders.find_one({"id": order_id})
+    if not order_data:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    # Generate unique filename
+    file_id = str(uuid.uuid4())
+    file_extension = Path(file.filename).suffix
+    unique_filename = f"{file_id}{file_extension}"
+    
+    # Save file in chunks so large drawings are never held in memory at once
+    async def read_chunks():
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+    
+    await default_storage.write(unique_filename, read_chunks())
+    job_id = await attach_file(order_id, file_id, unique_filename, file.filename, default_storage)
+    return {"message": "File uploaded successfully", "file_id": file_id, "job_id": job_id}
+
+async def attach_file(order_id: str, file_id: str, key: str, original_filename: str, backend) -> str:
+    """Record a stored file on the order and queue its background processing"""
+    # Create file info; hashing and metadata extraction run in the background
+    job_id = str(uuid.uuid4())
+    file_info = FileInfo(
+        id=file_id,
+        filename=key,
+        original_filename=original_filename,
+        file_path=str(backend.path(key)) if backend.name == 'local' else None,
+        storage=backend.name,
+        storage_key=key,
+        status=FileStatus.PENDING,
+        job_id=job_id
+    )
+    
+    # Add file to order
+    await db.orders.update_one(
+        {"id": order_id},
+        {"$push": {"files": file_info.dict()}, "$set": await revision_stamp()}
+    )
+    await job_queue.enqueue('process_file', {
+        'order_id': order_id,
+        'file_id': file_id,
+        'storage': backend.name,
+        'storage_key': key,
+    }, job_id=job_id)
+    await invalidation_bus.publish(f"order:{order_id}", "orders")
+    return job_id
+
+class PresignedUploadRequest(BaseModel):
+    filename: str
+    content_type: str = 'application/octet-stream'
+
+@api_router.post("/orders/{order_id}/files/presign")
+async def presign_file_upload(
+    order_id: str,
+    upload_request: PresignedUploadRequest,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can upload files")
+    if not default_storage.supports_presigned:
+        raise HTTPException(status_code=400, detail="Direct uploads are not supported by the current storage backend")
+    if not await db.orders.find_one({"id": order_id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    file_id = str(uuid.uuid4())
+    key = f"{file_id}{Path(upload_request.filename).suffix}"
+    # Имя и ключ подписываются в токене, чтобы при подтверждении нельзя было подменить объект
+    upload_token = jwt.encode({
+        'order_id': order_id,
+        'file_id': file_id,
+        'key': key,
+        'filename': upload_request.filename,
+        'exp': datetime.now(timezone.utc).timestamp() + default_storage.expires,
+    }, JWT_SECRET, algorithm='HS256')
+    return {
+        "file_id": file_id,
+        "upload": default_storage.presigned_upload(key, upload_request.content_type),
+        "upload_token": upload_token,
+    }
+
+class CompleteUploadRequest(BaseModel):
+    upload_token: str
+
+@api_router.post("/orders/{order_id}/files/complete")
+async def complete_file_upload(
+    order_id: str,
+    complete_request: CompleteUploadRequest,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can upload files")
+    try:
+        upload = jwt.decode(complete_request.upload_token, JWT_SECRET, algorithms=['HS256'])
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=400, detail="Invalid upload token")
+    if upload['order_id'] != order_id:
+        raise HTTPException(status_code=400, detail="Upload token belongs to another order")
+    if not await default_storage.exists(upload['key']):
+        raise HTTPException(status_code=409, detail="File has not been uploaded yet")
+    if await db.orders.find_one({"id": order_id, "files.id": upload['file_id']}, {"_id": 1}):
+        return {"message": "File uploaded successfully", "file_id": upload['file_id']}
+    
+    job_id = await attach_file(order_id, upload['file_id'], upload['key'], upload['filename'], default_storage)
+    return {"message": "File uploaded successfully", "file_id": upload['file_id'], "job_id": job_id}
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await job_queue.collection.find_one({"id": job_id}, {"_id": 0, "payload": 0, "locked_by": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+async def find_order_file(order_id: str, file_id: str, include_archived: bool = False) -> Optional[dict]:
+    """Attachment metadata of an order, looked up in the archive too when asked"""
+    query = {"id": order_id, "files.id": file_id}
+    order_data = await db.orders.find_one(query, {"files.$": 1})
+    if not order_data and include_archived:
+        order_data = await db[ARCHIVE_COLLECTION].find_one(query, {"files.$": 1})
+    return order_data['files'][0] if order_data else None
+
+@api_router.get("/orders/{order_id}/files/{file_id}")
+async def download_file(
+    order_id: str,
+    file_id: str,
+    include_archived: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can download files")
+    
+    file_info = await find_order_file(order_id, file_id, include_archived)
+    if not file_info:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    backend, key = file_location(file_info)
+    if not await backend.exists(key):
+        raise HTTPException(status_code=404, detail="File does not exist in storage")
+    
+    # S3 отдаёт редирект на подписанную ссылку: байты не проходят через API
+    return backend.download_response(key, file_info['original_filename'])
+
+class ThroughputPeriod(str, Enum):
+    DAY = "day"
+    WEEK = "week"
+    MONTH = "month"
+
+@api_router.get("/reports/throughput")
+async def get_throughput_report(
+    period: ThroughputPeriod = ThroughputPeriod.WEEK,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    stage: Optional[str] = None,
+    processing_type: Optional[ProcessingType] = None,
+    responsible_person: Optional[str] = None,
+    group_by_person: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can view reports")
+    
+    match = {}
+    if date_from or date_to:
+        match['day'] = {}
+        if date_from:
+            match['day']['$gte'] = to_bson_date(date_from)
+        if date_to:
+            match['day']['$lte'] = to_bson_date(date_to)
+    if stage:
+        match['stage'] = stage
+    if processing_type:
+        match['processing_type'] = processing_type.value
+    if responsible_person is not None:
+        match['responsible_person'] = responsible_person
+    
+    group_id = {
+        'period': {'$dateTrunc': {'date': '$day', 'unit': period.value, 'startOfWeek': 'monday'}},
+        'stage': '$stage',
+        'processing_type': '$processing_type',
+    }
+    if group_by_person:
+        group_id['responsible_person'] = '$responsible_person'
+    pipeline = [
+        {'$match': match},
+        {'$group': {'_id': group_id, 'units': {'$sum': '$units'}, 'completions': {'$sum': '$completions'}}},
+        {'$sort': {'_id.period': 1, '_id.stage': 1, '_id.processing_type': 1}},
+    ]
+    rows = []
+    async for row in read_db('reports')[ROLLUP_COLLECTION].aggregate(pipeline):
+        rows.append({**row['_id'], 'units': row['units'], 'completions': row['completions']})
+    return {"period": period.value, "rows": rows}
+
+@api_router.get("/reports/estimate-accuracy")
+async def get_estimate_accuracy_report(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can view reports")
+    
+    report = await read_db('reports')[REPORTS_COLLECTION].find_one({'_id': ESTIMATE_ACCURACY_REPORT}, {'_id': 0})
+    if report is None:
+        raise HTTPException(status_code=404, detail="Report has not been computed yet")
+    return report
+
+@api_router.post("/reports/estimate-accuracy/refresh")
+async def refresh_estimate_accuracy_report(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can refresh reports")
+    
+    job_id = await job_queue.enqueue('estimate_accuracy', {})
+    return {"message": "Report refresh started", "job_id": job_id}
+
+@api_router.get("/reports/wip")
+async def get_wip_report(current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can view reports")
+    return await wip_reports.get()
+
+class QuoteRequest(BaseModel):
+    quantity: int
+    market_type: MarketType
+    material_cost: float = 0
+    processing_time_per_unit: float = 0
+    processing_types: List[ProcessingType] = []
+    k: int = 5
+    shipped_only: bool = True  # только выполненные заказы с фактическими сроками
+
+@api_router.post("/quotes/similar")
+async def similar_orders_quote(quote_request: QuoteRequest, current_user: User = Depends(get_current_user)):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can request quotes")
+    if not 1 <= quote_request.k <= 50:
+        raise HTTPException(status_code=400, detail="k must be between 1 and 50")
+    
+    await quote_index.refresh()
+    vector = quote_features(
+        quote_request.quantity, quote_request.market_type.value, quote_request.material_cost,
+        quote_request.processing_time_per_unit, [t.value for t in quote_request.processing_types]
+    )
+    return {
+        "indexed_orders": len(quote_index.ids),
+        "similar": quote_index.nearest(vector, quote_request.k, quote_request.shipped_only),
+    }
+
+@api_router.get("/forecasts")
+async def get_delivery_forecasts(current_user: User = Depends(get_current_user)):
+    await deliveries.refresh()
+    forecasts = sorted(deliveries.forecasts.values(), key=lambda f: f['ship_date_p90'])
+    return {"simulations": deliveries.simulations, "forecasts": forecasts}
+
+@api_router.get("/orders/{order_id}/forecast")
+async def get_order_forecast(order_id: str, current_user: User = Depends(get_current_user)):
+    await deliveries.refresh()
+    forecast = deliveries.forecasts.get(order_id)
+    if forecast is None:
+        raise HTTPException(status_code=404, detail="No forecast for this order (not found or already shipped)")
+    return forecast
+
+@api_router.get("/orders/{order_id}/files/{file_id}/preview")
+async def preview_file(
+    order_id: str,
+    file_id: str,
+    size: int = PREVIEW_DEFAULT_SIZE,
+    include_archived: bool = False,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can view files")
+    if size not in PREVIEW_SIZES:
+        raise HTTPException(status_code=400, detail=f"Preview size must be one of {list(PREVIEW_SIZES)}")
+    
+    file_info = await find_order_file(order_id, file_id, include_archived)
+    if not file_info:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    if not file_info.get('sha256'):
+        # Файл ещё обрабатывается в фоне
+        return JSONResponse(
+            status_code=202,
+            content={"status": file_info.get('status', FileStatus.PENDING.value), "job_id": file_info.get('job_id')},
+            headers={"Retry-After": "1"},
+        )
+    if not is_previewable(file_info.get('content_type')):
+        raise HTTPException(status_code=415, detail="Preview is not available for this file type")
+    backend, key = file_location(file_info)
+    if not preview_cache.path_for(file_info['sha256'], size).exists() and not await backend.exists(key):
+        raise HTTPException(status_code=404, detail="File does not exist in storage")
+    
+    try:
+        preview_path = await preview_cache.get_or_render(
+            lambda: backend.local_copy(key), file_info['sha256'], file_info['content_type'], size
+        )
+    except Exception as e:
+        logger.error(f"Preview rendering failed for file {file_id}: {e}")
+        raise HTTPException(status_code=500, detail="Preview rendering failed")
+    
+    # Превью адресуется хешем содержимого, поэтому его можно кешировать в браузере надолго
+    return FileResponse(
+        path=preview_path,
+        media_type='image/jpeg',
+        headers={"Cache-Control": "private, max-age=86400", "ETag": f'"{file_info["sha256"]}-{size}"'}
+    )
+
+@api_router.get("/notifications")
+async def get_notifications(
+    since: Optional[datetime] = None,
+    limit: int = 100,
+    current_user: User = Depends(get_current_user)
+):
+    if not 1 <= limit <= 500:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 500")
+    
+    query = {'created_at': {'$gt': since}} if since else {}
+    notifications = await db.notifications.find(query, {'_id': 0, 'key': 0}).sort(
+        'created_at', -1
+    ).limit(limit).to_list(limit)
+    return {"notifications": notifications}
+
+@api_router.get("/health/db")
+async def db_health():
+    started = time.perf_counter()
+    try:
+        await db.command('ping')
+        status = "ok"
+    except Exception as e:
+        status = f"error: {e}"
+    ping_ms = round((time.perf_counter() - started) * 1000, 2)
+    options = mongo_client_options()
+    return {
+        "status": status,
+        "ping_ms": ping_ms,
+        "pool": pool_stats.snapshot(),
+        "config": {
+            "max_pool_size": options['maxPoolSize'],
+            "min_pool_size": options['minPoolSize'],
+            "wait_queue_timeout_ms": options['waitQueueTimeoutMS'],
+            "server_selection_timeout_ms": options['serverSelectionTimeoutMS'],
+            "read_preference": options['readPreference'],
+            "compressors": options.get('compressors'),
+            "read_routes": read_routes,
+            "max_staleness_seconds": MONGO_MAX_STALENESS_SECONDS,
+        },
+    }
+
+@api_router.get("/health/cache")
+async def cache_health():
+    return {"worker_id": WORKER_ID, "hot_reads": hot_reads.stats()}
+
+@api_router.get("/health/admission")
+async def admission_health():
+    return {"enabled": ADMISSION_ENABLED, **admission.stats()}
+
+@api_router.get("/health/loop")
+async def loop_health():
+    if not LOOP_WATCHDOG_ENABLED:
+        return {"enabled": False}
+    return {"enabled": True, **loop_watchdog.stats()}
+
+@api_router.get("/health/loop/stalls")
+async def loop_stalls(current_user: User = Depends(get_current_user)):
+    # Стеки раскрывают исходный код, поэтому доступны только менеджерам
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can view loop stall traces")
+    return {"enabled": LOOP_WATCHDOG_ENABLED, "stalls": list(loop_watchdog.stalls)}
+
+@api_router.delete("/orders/{order_id}")
+async def delete_order(
+    order_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role != UserRole.MANAGER:
+        raise HTTPException(status_code=403, detail="Only managers can delete orders")
+    
+    result = await db.orders.delete_one({"id": order_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Order not found")
+    
+    await db[SEARCH_COLLECTION].delete_one({'order_id': order_id})
+    await record_tombstones([order_id])
+    await invalidation_bus.publish(f"order:{order_id}", "orders")
+    return {"message": "Order deleted successfully"}
+
+# Include router
+app.include_router(api_router)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=True,
+    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+# Configure logging
+# Обработчики с вводом-выводом работают в отдельном потоке: запись в лог из обработчика
+# запроса сводится к постановке записи в очередь
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')  # json | text
+# Доля логируемых запросов для частых маршрутов, например {"GET /api/orders": 0.05}
+LOG_SAMPLE_RATES = json.loads(os.environ.get('LOG_SAMPLE_RATES', '{}'))
+LOG_SLOW_REQUEST_MS = float(os.environ.get('LOG_SLOW_REQUEST_MS', '1000'))
+# Журнал доступа uvicorn дублирует request_logging и не поддерживает выборку
+LOG_UVICORN_ACCESS = os.environ.get('LOG_UVICORN_ACCESS', 'false').lower() == 'true'
+
+request_context = contextvars.ContextVar('request_context', default=None)
+
+class RequestContextFilter(logging.Filter):
+    """Copy the current request's id, user and route onto records before they leave the task"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = request_context.get()
+        if context:
+            for key, value in context.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    FIELDS = ('request_id', 'user_id', 'method', 'route', 'status', 'duration_ms', 'worker')
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class DeferredFormatQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records without formatting them, leaving traceback rendering to the listener.
+
+    The stock prepare() formats on the caller's thread and drops exc_info. Only the message
+    arguments are merged here, so the record does not depend on objects that may change later."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def configure_logging() -> logging.handlers.QueueListener:
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredFormatQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # uvicorn настраивает свои логгеры до импорта приложения, с синхронными обработчиками
+    # и без передачи записей корневому логгеру; переводим их на общую очередь
+    for name in ('uvicorn', 'uvicorn.error', 'uvicorn.access'):
+        server_logger = logging.getLogger(name)
+        server_logger.handlers = []
+        server_logger.propagate = True
+    logging.getLogger('uvicorn.access').disabled = not LOG_UVICORN_ACCESS
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+log_listener = configure_logging()
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(f'{__name__}.access')
+
+def bind_request_user(user_id: str):
+    context = request_context.get()
+    if context is not None:
+        context['user_id'] = user_id
+
+@app.middleware("http")
+async def request_logging(request: Request, call_next):
+    request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    # Словарь общий для middleware и обработчика: user_id дописывается при аутентификации
+    context = {'request_id': request_id, 'method': request.method, 'worker': WORKER_ID}
+    request_context.set(context)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers['X-Request-ID'] = request_id
+        return response
+    finally:
+        duration_ms = (time.perf_counter() - started) * 1000
+        route = request.scope.get('route')
+        context['route'] = route.path if route is not None else request.url.path
+        rate = LOG_SAMPLE_RATES.get(f"{request.method} {context['route']}", 1.0)
+        # Ошибки и медленные запросы логируются всегда, остальное — с заданной долей
+        if status >= 500 or duration_ms >= LOG_SLOW_REQUEST_MS or rate >= 1.0 or random.random() < rate:
+            access_logger.info(
+                f"{request.method} {context['route']} {status} {duration_ms:.1f}ms",
+                extra={'status': status, 'duration_ms': round(duration_ms, 1)},
+            )
+
+@app.on_event("startup")
+async def start_invalidation_bus():
+    await invalidation_bus.start()
+
+@app.on_event("startup")
+async def load_stage_registry():
+    await stage_registry.seed()
+    await stage_registry.load()
+    await workflow_registry.seed()
+    await workflow_registry.load()
+    await registry_reloader.start()
+
+@app.on_event("startup")
+async def create_indexes():
+    # Диапазонные запросы по датам этапов (сроки, просрочки, отчёты)
+    await db.orders.create_index('stages.end_date')
+    await ensure_search_indexes()
+    await ensure_sync_indexes()
+    await ensure_order_number_index()
+    await ensure_rollup_indexes()
+    await ensure_archive_collection()
+    await ensure_overdue_indexes()
+
+@app.on_event("startup")
+async def start_job_queue():
+    await job_queue.start()
+
+@app.on_event("startup")
+async def start_counter_buffer():
+    await counter_buffer.start()
+
+@app.on_event("startup")
+async def start_overdue_detector():
+    await overdue_detector.start()
+
+@app.on_event("startup")
+async def start_loop_watchdog():
+    if LOOP_WATCHDOG_ENABLED:
+        await loop_watchdog.start()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await registry_reloader.stop()
+    await loop_watchdog.stop()
+    await overdue_detector.stop()
+    await counter_buffer.stop()
+    await job_queue.stop()
+    await invalidation_bus.stop()
+    client.close()
+    log_listener.stop()
\ No newline at end of file
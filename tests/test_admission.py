@@ -0,0 +1,69 @@
+"""Admission control: 429 when a class queue is full, 503 when shedding or timing out"""
+import asyncio
+
+import pytest
+
+from server import AdmissionController, AdmissionRejected
+
+CLASSES = {
+    'critical': {'priority': 0, 'max_concurrent': 2, 'max_queue': 1, 'queue_timeout': 0.05, 'global_share': 1.0},
+    'bulk': {'priority': 2, 'max_concurrent': 4, 'max_queue': 4, 'queue_timeout': 1.0, 'global_share': 0.5},
+}
+
+
+def test_full_queue_is_rejected_with_429():
+    async def scenario():
+        controller = AdmissionController(max_inflight=10, classes=CLASSES)
+        critical = controller.classes['critical']
+        await controller.acquire(critical)
+        await controller.acquire(critical)
+        queued = asyncio.ensure_future(controller.acquire(critical))
+        await asyncio.sleep(0)
+        assert critical.waiting == 1
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire(critical)
+        assert rejected.value.status_code == 429
+        assert critical.rejected_queue_full == 1
+
+        # Освободившееся место достаётся запросу из очереди
+        controller.release(critical)
+        await queued
+        assert critical.inflight == 2 and critical.waiting == 0
+
+    asyncio.run(scenario())
+
+
+def test_queue_timeout_is_rejected_with_503():
+    async def scenario():
+        controller = AdmissionController(max_inflight=10, classes=CLASSES)
+        critical = controller.classes['critical']
+        await controller.acquire(critical)
+        await controller.acquire(critical)
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire(critical)
+        assert rejected.value.status_code == 503
+        assert critical.rejected_timeout == 1
+        assert critical.waiting == 0
+
+    asyncio.run(scenario())
+
+
+def test_low_priority_class_is_shed_with_503_when_saturated():
+    async def scenario():
+        controller = AdmissionController(max_inflight=4, classes=CLASSES)
+        critical, bulk = controller.classes['critical'], controller.classes['bulk']
+        await controller.acquire(bulk)
+        await controller.acquire(critical)
+
+        # Занята половина общей ёмкости: bulk сбрасывается сразу, critical ещё проходит
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire(bulk)
+        assert rejected.value.status_code == 503
+        assert rejected.value.retry_after == controller.retry_after
+        assert bulk.shed == 1
+        await controller.acquire(critical)
+        assert controller.inflight == 3
+
+    asyncio.run(scenario())
@@ -0,0 +1,34 @@
+"""ETags and If-None-Match handling for order endpoints"""
+import pytest
+from starlette.requests import Request
+
+import server
+from server import etag_matches
+
+
+def request_with(if_none_match=None):
+    headers = [(b'if-none-match', if_none_match.encode())] if if_none_match is not None else []
+    return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': headers})
+
+
+@pytest.mark.parametrize('header, etag, expected', [
+    (None, 'W/"orders-1"', False),
+    ('W/"orders-1"', 'W/"orders-1"', True),
+    ('"orders-1"', 'W/"orders-1"', True),  # слабое сравнение игнорирует W/
+    ('"other", W/"orders-1"', 'W/"orders-1"', True),
+    ('"orders-2"', 'W/"orders-1"', False),
+    ('*', '"order-abc"', True),
+])
+def test_etag_matches(header, etag, expected):
+    assert etag_matches(request_with(header), etag) is expected
+
+
+def test_orders_collection_etag_follows_returned_versions():
+    versions = [{'id': 'a', 'revision': 5}, {'id': 'b', 'revision': 7}]
+    etag = server.orders_collection_etag(server.UserRole.MANAGER, versions, False)
+    # Поздняя запись с меньшей ревизией всё равно меняет ETag
+    bumped = [{'id': 'a', 'revision': 6}, {'id': 'b', 'revision': 7}]
+    assert server.orders_collection_etag(server.UserRole.MANAGER, bumped, False) != etag
+    assert server.orders_collection_etag(server.UserRole.EMPLOYEE, versions, False) != etag
+    assert server.orders_collection_etag(server.UserRole.MANAGER, versions, True) != etag
+    assert server.orders_collection_etag(server.UserRole.MANAGER, list(versions), False) == etag
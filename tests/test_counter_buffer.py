@@ -0,0 +1,46 @@
+"""Write-behind buffer of stage unit increments"""
+import asyncio
+
+import server
+from server import StageCounterBuffer
+
+
+def test_flush_requeues_failed_writes_and_drops_invalid_ones(monkeypatch):
+    outcomes = {
+        'broken': RuntimeError('primary stepped down'),
+        'binary': ValueError('Stage does not count units'),
+        'missing': None,
+        'ok': {'completed_units': 5},
+    }
+    calls = []
+
+    async def increment_stage_units(order_id, stage_id, delta):
+        calls.append((order_id, stage_id, delta))
+        outcome = outcomes[order_id]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(server, 'increment_stage_units', increment_stage_units)
+
+    async def scenario():
+        buffer = StageCounterBuffer(interval=1.0)
+        for order_id in outcomes:
+            buffer.add(order_id, 'milling', 3)
+        buffer.add('ok', 'milling', 2)
+        await buffer.flush()
+
+        assert ('ok', 'milling', 5) in calls
+        # Сбой записи возвращает дельту в буфер, ошибки данных и пропавшие этапы — нет
+        assert buffer._pending == {('broken', 'milling'): 3}
+        assert buffer.flushes == 1
+
+        # Новые сканы складываются с возвращённой дельтой и уходят одной записью
+        buffer.add('broken', 'milling', 4)
+        outcomes['broken'] = {'completed_units': 7}
+        calls.clear()
+        await buffer.flush()
+        assert calls == [('broken', 'milling', 7)]
+        assert buffer._pending == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,45 @@
+"""Estimate-vs-actual processing time report"""
+from datetime import datetime, timezone
+
+import pytest
+
+from server import compute_estimate_accuracy
+
+
+def row(order_id, estimated, units, days, client='Клиент', person='Иван', types=('milling',)):
+    start = datetime(2026, 3, 1, tzinfo=timezone.utc)
+    return {
+        'order_id': order_id,
+        'client_name': client,
+        'responsible_person': person,
+        'processing_types': list(types),
+        'estimated': estimated,
+        'units': units,
+        'start_date': start,
+        'end_date': start.replace(day=start.day + days - 1),
+    }
+
+
+def test_compute_estimate_accuracy():
+    rows = [
+        row('a', 48.0, 10, 1),  # 480 мин / 10 шт = 48: оценка точная
+        row('b', 24.0, 10, 2, client='Другой', person=None, types=('milling', 'turning')),  # 96 против 24
+        row('c', 0, 10, 1),  # без оценки — не учитывается
+        row('d', 10.0, 0, 1),  # без количества — не учитывается
+    ]
+    report = compute_estimate_accuracy(rows, 480.0)
+
+    assert report['orders'] == 2
+    assert report['overall']['ratio_median'] == pytest.approx(2.5)
+    by_type = {item['key']: item for item in report['by_processing_type']}
+    assert by_type['milling']['orders'] == 2
+    assert by_type['turning']['ratio_median'] == pytest.approx(4.0)
+    by_person = {item['key']: item for item in report['by_responsible_person']}
+    assert set(by_person) == {'Иван', 'не назначен'}
+    assert by_person['Иван']['abs_pct_error_mean'] == pytest.approx(0.0)
+
+
+def test_compute_estimate_accuracy_without_data():
+    report = compute_estimate_accuracy([], 480.0)
+    assert report['orders'] == 0
+    assert report['by_client'] == []
@@ -0,0 +1,17 @@
+"""Monte Carlo delivery forecasts"""
+import numpy as np
+
+import server
+
+
+def test_forecast_simulation():
+    forecaster = server.DeliveryForecaster(simulations=500)
+    forecaster.durations = {('qc', None): np.array([1.0, 2.0, 3.0]), ('packing', None): np.array([2.0])}
+    orders = [
+        {'id': 'a', 'stages': [{'code': 'qc', 'status': 'pending'}, {'code': 'packing', 'status': 'pending'}]},
+        {'id': 'b', 'stages': [{'code': 'qc', 'status': 'completed'},
+                               {'code': 'packing', 'status': 'in_progress', 'percentage': 50}]},
+    ]
+    forecasts = forecaster._simulate(orders)
+    assert 3.0 <= forecasts['a']['remaining_days_p50'] <= forecasts['a']['remaining_days_p90'] <= 5.0
+    assert forecasts['b']['remaining_days_p50'] == forecasts['b']['remaining_days_p90'] == 1.0
@@ -0,0 +1,28 @@
+"""Single-flight coalescing and the micro-TTL cache of hot reads"""
+import asyncio
+
+from server import HotReadCache
+
+
+def test_identical_reads_share_one_computation_until_invalidated():
+    calls = []
+
+    async def scan():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'W/"orders-1"'
+
+    async def scenario():
+        cache = HotReadCache(ttl=60)
+        key = ('orders/etag', 'manager', False)
+        results = await asyncio.gather(*[cache.get(key, scan) for _ in range(40)])
+        assert set(results) == {'W/"orders-1"'}
+        assert len(calls) == 1
+        await cache.get(key, scan)
+        assert len(calls) == 1
+        # Запись заказа публикует ключ "orders" и сбрасывает закешированную версию
+        cache.invalidate('orders')
+        await cache.get(key, scan)
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
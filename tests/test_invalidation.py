@@ -0,0 +1,60 @@
+"""Cross-worker invalidation through a tailed capped collection"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+import server
+from server import MongoCappedInvalidationTransport
+
+
+class FakeTailableCursor:
+    """Returns what the collection holds at iteration time once, then dies like a cursor that lost its position"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.alive = True
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for message in list(self.messages):
+            yield message
+        self.alive = False
+
+
+class FakeCappedCollection:
+    def __init__(self):
+        self.messages = []  # в порядке вставки, как $natural
+
+    def find(self, query=None, projection=None, cursor_type=None):
+        bound = (query or {}).get('_id', {}).get('$gt')
+        return FakeTailableCursor([m for m in self.messages if bound is None or m['_id'] > bound])
+
+
+def test_tail_delivers_out_of_order_ids_once(monkeypatch):
+    real_sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, 'sleep', lambda delay: real_sleep(min(delay, 0.01)))
+    collection = FakeCappedCollection()
+    now = datetime.now(timezone.utc)
+    collection.messages.append({'_id': ObjectId.from_datetime(now - timedelta(minutes=1)), 'keys': ['old']})
+
+    async def scenario():
+        transport = MongoCappedInvalidationTransport({'cache_invalidations': collection})
+        delivered = []
+        task = asyncio.ensure_future(transport._tail(delivered.extend))
+        await real_sleep(0.02)
+        # Второй воркер вставляет сообщение позже, но его ObjectId меньше: часы и счётчики у воркеров свои
+        later = ObjectId.from_datetime(now + timedelta(seconds=1))
+        earlier = ObjectId.from_datetime(now)
+        collection.messages.append({'_id': later, 'origin': 'worker-a', 'keys': ['order:1']})
+        await real_sleep(0.05)
+        collection.messages.append({'_id': earlier, 'origin': 'worker-b', 'keys': ['order:2']})
+        collection.messages.append({'_id': ObjectId(), 'origin': server.WORKER_ID, 'keys': ['own']})
+        await real_sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return delivered
+
+    assert asyncio.run(scenario()) == ['order:1', 'order:2']
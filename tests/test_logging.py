@@ -0,0 +1,22 @@
+"""Queued JSON logging"""
+import json
+import logging
+import queue
+import sys
+
+import server
+
+
+def test_queued_records_keep_traceback_for_the_listener():
+    handler = server.DeferredFormatQueueHandler(queue.SimpleQueue())
+    try:
+        raise ZeroDivisionError('boom')
+    except ZeroDivisionError:
+        record = logging.getLogger('test').makeRecord(
+            'test', logging.ERROR, __file__, 1, 'failed %s', ('job',), exc_info=sys.exc_info()
+        )
+    prepared = handler.prepare(record)
+    assert prepared.getMessage() == 'failed job'
+    entry = json.loads(server.JsonFormatter().format(prepared))
+    assert entry['message'] == 'failed job'
+    assert 'ZeroDivisionError: boom' in entry['exc_info']
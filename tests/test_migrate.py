@@ -0,0 +1,52 @@
+"""Migrations against a real MongoDB; skipped when none is reachable at MONGO_URL"""
+import asyncio
+import os
+import uuid
+from datetime import date, datetime, timezone
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import migrate
+
+
+def baseline_order() -> dict:
+    """An order as the pre-migration API stored it: prepare_for_mongo wrote every date with isoformat()"""
+    return {
+        'id': str(uuid.uuid4()),
+        'order_number': 'A-1',
+        'created_at': datetime(2025, 3, 5, 10, 15, 30, 123456, tzinfo=timezone.utc).isoformat(),
+        'stages': [
+            {'id': str(uuid.uuid4()), 'name': 'Закупка материала', 'status': 'completed',
+             'start_date': date(2025, 3, 5).isoformat(), 'end_date': date(2025, 3, 7).isoformat()},
+            {'id': str(uuid.uuid4()), 'name': 'Фрезеровка', 'status': 'pending',
+             'start_date': None, 'end_date': None},
+        ],
+    }
+
+
+async def migrate_baseline_order():
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'], serverSelectionTimeoutMS=500)
+    try:
+        await client.admin.command('ping')
+    except Exception:
+        client.close()
+        pytest.skip('MongoDB is not reachable')
+    db = client[f"test_migrate_{uuid.uuid4().hex[:8]}"]
+    try:
+        order = baseline_order()
+        await db.orders.insert_one(dict(order))
+        remaining = await migrate.migrate_stage_dates_to_bson(db, batch_size=10)
+        return remaining, order, await db.orders.find_one({'id': order['id']})
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+def test_stage_dates_migration_converts_baseline_order():
+    remaining, order, migrated = asyncio.run(migrate_baseline_order())
+    assert remaining == 0
+    assert migrated['created_at'] == datetime(2025, 3, 5, 10, 15, 30, 123000)
+    assert migrated['stages'][0]['start_date'] == datetime(2025, 3, 5)
+    assert migrated['stages'][0]['end_date'] == datetime(2025, 3, 7)
+    assert migrated['stages'][1]['start_date'] is None
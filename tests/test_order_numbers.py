@@ -0,0 +1,61 @@
+"""Order number allocation from reserved counter blocks"""
+import asyncio
+from datetime import datetime, timezone
+
+import server
+from server import MarketType, OrderNumberAllocator
+
+
+class FakeCounterAllocator(OrderNumberAllocator):
+    """Counters kept in memory instead of db.counters"""
+
+    def __init__(self, block_size: int):
+        super().__init__(block_size)
+        self.counters = {}
+        self.reservations = []
+
+    async def _reserve(self, counter_id: str, count: int) -> int:
+        self.reservations.append((counter_id, count))
+        self.counters[counter_id] = self.counters.get(counter_id, 0) + count
+        return self.counters[counter_id] - count + 1
+
+
+def sequence(numbers):
+    return [int(number.rsplit('-', 1)[1]) for number in numbers]
+
+
+def test_numbers_come_from_reserved_blocks():
+    async def scenario():
+        allocator = FakeCounterAllocator(block_size=5)
+        year = datetime.now(timezone.utc).year
+        counter_id = f"order_number:{year}:domestic"
+
+        first = await allocator.allocate(MarketType.DOMESTIC)
+        assert first == [server.ORDER_NUMBER_FORMAT.format(prefix='UA-', year=year, seq=1)]
+        assert sequence(await allocator.allocate(MarketType.DOMESTIC, 3)) == [2, 3, 4]
+        assert allocator.reservations == [(counter_id, 5)]
+
+        # В блоке остался один номер: партия из двух берёт новый блок, чтобы номера шли подряд
+        assert sequence(await allocator.allocate(MarketType.DOMESTIC, 2)) == [6, 7]
+        # Партия больше блока резервируется целиком
+        assert sequence(await allocator.allocate(MarketType.DOMESTIC, 7)) == [11, 12, 13, 14, 15, 16, 17]
+        assert allocator.reservations == [(counter_id, 5), (counter_id, 5), (counter_id, 7)]
+        assert allocator.counters[counter_id] == 17
+
+        # У другого рынка свой счётчик
+        assert sequence(await allocator.allocate(MarketType.FOREIGN)) == [1]
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_allocations_never_share_a_number():
+    async def scenario():
+        allocator = FakeCounterAllocator(block_size=3)
+        batches = await asyncio.gather(*[allocator.allocate(MarketType.DOMESTIC, n % 4 + 1) for n in range(20)])
+        numbers = [number for batch in batches for number in batch]
+        assert len(numbers) == len(set(numbers))
+        for batch in batches:
+            seqs = sequence(batch)
+            assert seqs == list(range(seqs[0], seqs[0] + len(seqs)))
+
+    asyncio.run(scenario())
@@ -0,0 +1,31 @@
+"""Preview rendering of image and PDF attachments"""
+from PIL import Image
+
+from server import PREVIEW_PDF_TYPE, render_preview
+
+
+def test_pdf_preview_renders_first_page(tmp_path):
+    source = tmp_path / 'drawing.pdf'
+    first, second = Image.new('RGB', (1200, 600), 'red'), Image.new('RGB', (600, 1200), 'blue')
+    first.save(source, 'PDF', save_all=True, append_images=[second], resolution=72)
+    target = tmp_path / 'preview.jpg'
+
+    render_preview(str(source), str(target), PREVIEW_PDF_TYPE, 256)
+
+    with Image.open(target) as preview:
+        assert preview.format == 'JPEG'
+        assert max(preview.size) == 256 and preview.size[0] > preview.size[1]
+        red, green, blue = preview.getpixel((preview.size[0] // 2, preview.size[1] // 2))
+        assert red > 200 and green < 60 and blue < 60
+
+
+def test_image_preview_is_downscaled(tmp_path):
+    source = tmp_path / 'photo.png'
+    Image.new('RGBA', (2000, 1000), (0, 128, 0, 255)).save(source)
+    target = tmp_path / 'preview.jpg'
+
+    render_preview(str(source), str(target), 'image/png', 512)
+
+    with Image.open(target) as preview:
+        assert preview.size == (512, 256)
+        assert preview.mode == 'RGB'
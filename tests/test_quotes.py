@@ -0,0 +1,20 @@
+"""Feature vectors behind similar-order quoting"""
+import numpy as np
+import pytest
+
+import server
+from server import quote_features
+
+
+def test_quote_features():
+    vector = quote_features(9, 'foreign', 90.0, 3.0, ['milling'])
+    offset = len(server.QUOTE_PROCESSING_TYPES)
+    assert vector.shape == (server.QUOTE_FEATURES,)
+    assert vector[server.QUOTE_PROCESSING_TYPES.index(server.ProcessingType.MILLING)] == 1.0
+    assert vector[:offset].sum() == 1.0
+    assert vector[offset] == 1.0
+    assert vector[offset + 1] == pytest.approx(np.log1p(9))
+    assert vector[offset + 2] == pytest.approx(np.log1p(3.0))
+    assert vector[offset + 3] == pytest.approx(np.log1p(10.0))
+    # Нулевое количество не приводит к делению на ноль
+    assert np.isfinite(quote_features(0, 'domestic', 100.0, 0, [])).all()
@@ -0,0 +1,18 @@
+"""Stage progress deltas behind the throughput rollups"""
+from server import stage_progress_deltas
+
+
+def test_stage_progress_deltas():
+    before = [
+        {'status': 'completed'},
+        {'status': 'in_progress', 'completed_units': 3},
+        {'status': 'pending', 'completed_units': None},
+        {'status': 'completed', 'completed_units': 10},
+    ]
+    after = [
+        {'status': 'completed'},
+        {'status': 'completed', 'completed_units': 10},
+        {'status': 'pending', 'completed_units': 0},
+        {'status': 'in_progress', 'completed_units': 8},
+    ]
+    assert stage_progress_deltas(before, after) == [(1, 7, 1), (3, -2, -1)]
@@ -0,0 +1,16 @@
+"""Gram extraction behind the full-text order search"""
+from server import query_grams, text_trigrams
+
+
+def test_text_trigrams_cover_short_fragments():
+    grams = text_trigrams('Вал AB-1234 ё')
+    assert {'ва', 'вал', 'ab', '12', '123', '234', '34', 'е'} <= set(grams)
+    for fragment in ('12', '23', '234', 'ab'):
+        assert set(query_grams(fragment)) <= set(grams)
+    assert not set(query_grams('1235')) <= set(grams)
+
+
+def test_query_grams_use_trigrams_for_long_words():
+    assert query_grams('ABCD') == ['abc', 'bcd']
+    assert query_grams('x') == ['x']
+    assert query_grams('  ') == []
@@ -0,0 +1,14 @@
+"""Revision cursors behind delta sync"""
+from datetime import datetime, timezone
+
+import server
+
+
+def test_settled_revision_stops_before_recent_changes():
+    now = datetime.now(timezone.utc)
+    old = now.replace(year=now.year - 1)
+    events = [(12, now), (10, old), (11, old), (13, old)]
+    # 12 ещё не устоялась: курсор не проходит ни её, ни всё, что после неё
+    assert server.settled_revision(5, events) == 11
+    assert server.settled_revision(5, []) == 5
+    assert server.settled_revision(5, [(6, None)]) == 5
@@ -0,0 +1,171 @@
+"""CompiledWorkflow against the hard-coded stage rules it replaced"""
+import copy
+import random
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+from server import CompiledWorkflow, StageStatus, Workflow, WorkflowRegistry, linear_workflow
+
+STATUSES = [s.value for s in StageStatus]
+TODAY = datetime(2026, 10, 19, tzinfo=timezone.utc)
+
+
+# Правила до перехода на маршруты (этапы 1-3 — да/нет, этапы 4-8 — по количеству деталей)
+def legacy_percentage(stage_index, stage, total_quantity, is_completed=False):
+    if stage_index < 3:
+        return 100 if is_completed else 0
+    completed_units = stage.get('completed_units', 0) or 0
+    if total_quantity > 0:
+        return min(100, round((completed_units / total_quantity) * 100))
+    return 0
+
+
+def legacy_cascade_units(stages, current_stage_index, total_quantity, current_stage_date=None):
+    if current_stage_index < 3:
+        return
+    current_units = stages[current_stage_index].get('completed_units', 0) or 0
+    if current_units > 0:
+        for i in range(3, current_stage_index):
+            prev_stage = stages[i]
+            if current_units > (prev_stage.get('completed_units', 0) or 0):
+                prev_stage['completed_units'] = current_units
+                prev_stage['percentage'] = legacy_percentage(i, prev_stage, total_quantity)
+                if prev_stage.get('status') == 'pending':
+                    prev_stage['status'] = 'in_progress'
+                if not prev_stage.get('start_date') and current_stage_date:
+                    prev_stage['start_date'] = current_stage_date
+
+
+def legacy_cascade_status(stages, current_stage_index, current_stage_status, current_stage_dates):
+    if current_stage_index >= 3 or current_stage_status != 'completed':
+        return
+    for i in range(current_stage_index):
+        prev_stage = stages[i]
+        if prev_stage.get('status') != 'completed':
+            prev_stage['status'] = 'completed'
+            prev_stage['percentage'] = 100
+            if not prev_stage.get('start_date'):
+                prev_stage['start_date'] = current_stage_dates.get('start_date') or current_stage_dates.get('end_date')
+            if not prev_stage.get('end_date'):
+                prev_stage['end_date'] = current_stage_dates.get('end_date')
+
+
+def legacy_update(stages, stage_index, quantity):
+    stage = stages[stage_index]
+    if stage_index < 3:
+        stage['percentage'] = legacy_percentage(stage_index, stage, quantity, stage.get('status') == 'completed')
+        legacy_cascade_status(stages, stage_index, stage.get('status'), {
+            'start_date': stage.get('start_date'), 'end_date': stage.get('end_date'),
+        })
+    else:
+        stage['percentage'] = legacy_percentage(stage_index, stage, quantity)
+        if (stage.get('completed_units', 0) or 0) > 0:
+            if stage.get('status') == 'pending':
+                stage['status'] = 'in_progress'
+            if not stage.get('start_date'):
+                stage['start_date'] = TODAY
+        legacy_cascade_units(stages, stage_index, quantity, stage.get('start_date'))
+
+
+def random_date(rng):
+    return rng.choice([None, datetime(2026, rng.randint(1, 12), rng.randint(1, 28), tzinfo=timezone.utc)])
+
+
+def random_stages(rng, workflow, quantity):
+    stages = []
+    for i, code in enumerate(workflow.codes):
+        stage = {'code': code, 'status': rng.choice(STATUSES)}
+        if workflow.kinds[i] == server.StageKind.UNITS:
+            stage['completed_units'] = rng.choice([None, rng.randint(0, quantity + 5)])
+        # Сохранённый процент всегда согласован с количеством: на этом держатся операторы $max
+        stage['percentage'] = workflow.percentage(i, stage, quantity)
+        for field in ('start_date', 'end_date'):
+            value = random_date(rng)
+            if value:
+                stage[field] = value
+        stages.append(stage)
+    return stages
+
+
+def normalized(stages):
+    # Старые правила записывали None в пустые даты, новые поле не трогают
+    return [{k: v for k, v in stage.items() if v is not None} for stage in stages]
+
+
+def apply_update(stages, set_ops, max_ops):
+    stages = copy.deepcopy(stages)
+    for path, value in set_ops.items():
+        _, index, field = path.split('.')
+        stages[int(index)][field] = value
+    for path, value in max_ops.items():
+        _, index, field = path.split('.')
+        current = stages[int(index)].get(field)
+        stages[int(index)][field] = value if current is None else max(current, value)
+    return stages
+
+
+@pytest.fixture(scope='module')
+def standard():
+    return CompiledWorkflow(server.DEFAULT_WORKFLOWS[0], server.stage_registry)
+
+
+def test_standard_workflow_kinds(standard):
+    assert standard.kinds[:3] == [server.StageKind.BINARY] * 3
+    assert standard.kinds[3:] == [server.StageKind.UNITS] * 5
+
+
+def test_apply_matches_legacy_rules(standard):
+    rng = random.Random(42)
+    for _ in range(20000):
+        quantity = rng.randint(0, 20)
+        stages = random_stages(rng, standard, quantity)
+        index = rng.randrange(len(stages))
+
+        expected = copy.deepcopy(stages)
+        legacy_update(expected, index, quantity)
+        actual = copy.deepcopy(stages)
+        set_ops, max_ops = standard.apply(actual, index, quantity, TODAY)
+
+        assert normalized(actual) == normalized(expected)
+        # Операторы обновления приводят сохранённый документ к тому же состоянию
+        assert normalized(apply_update(stages, set_ops, max_ops)) == normalized(actual)
+
+
+def test_apply_writes_only_what_it_recalculated(standard):
+    quantity = 10
+    stages = [{'code': code, 'status': 'pending'} for code in standard.codes]
+    stages[4].update(status='in_progress', completed_units=4, percentage=40, notes='смена 2', start_date=TODAY)
+
+    set_ops, max_ops = standard.apply(stages, 4, quantity, TODAY)
+
+    # Счётчик, заметки и даты этапа не переписываются из снимка: параллельный $inc не откатится
+    assert not any(path.startswith('stages.4.') for path in set_ops)
+    assert max_ops == {'stages.3.completed_units': 4, 'stages.3.percentage': 40}
+    assert set_ops == {'stages.3.status': 'in_progress', 'stages.3.start_date': TODAY}
+
+
+def test_workflow_rejects_forward_dependency():
+    workflow = Workflow(id='broken', name='Broken', stages=[
+        {'code': 'intake', 'depends_on': ['qc']},
+        {'code': 'qc'},
+    ])
+    with pytest.raises(ValueError):
+        CompiledWorkflow(workflow, server.stage_registry)
+
+
+def test_registry_keeps_old_versions_for_existing_orders():
+    codes = [d.code for d in server.DEFAULT_STAGE_DEFINITIONS]
+    v1 = linear_workflow('standard', 'Standard', codes)
+    v2 = linear_workflow('standard', 'Standard', codes[:-1])
+    v2.version = 2
+    registry = WorkflowRegistry([v2, v1])
+
+    assert registry.get('standard').codes == codes[:-1]
+    assert registry.get('standard', 1).codes == codes
+    # Заказ без версии создан до версионирования маршрутов
+    assert registry.for_order({'workflow': 'standard'}).codes == codes
+    assert registry.for_order({'workflow': 'standard', 'workflow_version': 2}).codes == codes[:-1]
+    with pytest.raises(ValueError):
+        registry.get('standard', 3)